@@ -0,0 +1,89 @@
+"""Общая основа буферов, которые записывают изменения в базу пачками
+
+Изменения копятся в памяти и записываются одной транзакцией раз в interval
+секунд или сразу по накоплении max_rows изменений. Если запись не удалась,
+пачка возвращается в буфер и попадает в следующую запись.
+"""
+import asyncio
+import logging
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Буфер с периодической записью пачками
+
+    Подкласс хранит изменения в своих структурах и реализует _take (забрать
+    пачку, очистив буфер), _restore (вернуть пачку после ошибки) и _write
+    (записать пачку). После каждого изменения подкласс вызывает _added.
+    description - что записывается, для сообщений об ошибках.
+    """
+
+    description = 'изменений'
+
+    def __init__(self, interval: float, max_rows: int):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+
+    @property
+    def running(self):
+        return self._task is not None and not self._closed
+
+    def _added(self, size: int):
+        """Запускает запись, не дожидаясь interval, если буфер заполнен"""
+        if size >= self.max_rows:
+            self._full.set()
+
+    def _take(self) -> Any:
+        """Забирает накопленную пачку и очищает буфер; пустая пачка не записывается"""
+        raise NotImplementedError
+
+    def _restore(self, batch: Any):
+        """Возвращает пачку в буфер, не затирая более новые изменения"""
+        raise NotImplementedError
+
+    async def _write(self, batch: Any):
+        raise NotImplementedError
+
+    async def flush(self):
+        """Записывает накопленные изменения"""
+        async with self._lock:
+            batch = self._take()
+            self._full.clear()
+            if not batch:
+                return
+            try:
+                await self._write(batch)
+            except BaseException:
+                self._restore(batch)
+                raise
+
+    async def _flush_periodically(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи {self.description}: {e}")
+
+    def start(self):
+        """Запускает периодическую запись"""
+        self._closed = False
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        """Останавливает периодическую запись и сбрасывает остаток буфера"""
+        self._closed = True
+        self._full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,66 @@
+"""Общие функции нагрузочных тестов"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def setup_env(db_path):
+    """Настраивает окружение до импорта модулей бота"""
+    os.environ['DB_PATH'] = db_path
+    os.environ.setdefault('BOT_TOKEN', '123456:bench')
+    os.environ.setdefault('ADMIN_IDS', '1')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def peak_rss_mb():
+    """Пиковое потребление памяти процессом, МБ"""
+    try:
+        import resource
+    except ImportError:
+        # На Windows модуля resource нет
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux значение в килобайтах, в macOS - в байтах
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, params, metrics, save=None):
+    """Печатает результат и при необходимости дописывает его в JSONL-файл
+
+    В записи есть коммит и параметры запуска, поэтому результаты разных
+    коммитов можно сравнивать между собой.
+    """
+    result = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': params,
+        'metrics': metrics,
+    }
+    for key, value in metrics.items():
+        print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+    if save:
+        with open(save, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return result
@@ -0,0 +1,64 @@
+"""Измеряет производительность операций с базой данных
+
+Пример:
+    python bench/db_ops.py --db bench.db --ops 50000 --save bench.jsonl
+"""
+import time
+import asyncio
+import argparse
+import logging
+
+import common
+
+
+async def run(args):
+    common.setup_env(args.db)
+    import database
+
+    # Журнал каждой подписки исказил бы замеры
+    logging.disable(logging.INFO)
+    await database.init_db()
+    await database.subscriber_cache.load()
+    database.subscriber_writer.start()
+    base = 9_000_000_000
+
+    started = time.perf_counter()
+    for i in range(args.ops):
+        if not await database.is_subscribed(base + i):
+            await database.add_subscriber(base + i, 'bench', 'Bench', None)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    await database.subscriber_writer.flush()
+    subscribe_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    streamed = 0
+    async for _ in database.iter_subscribers():
+        streamed += 1
+    stream_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(args.ops):
+        await database.remove_subscriber(base + i)
+    await database.subscriber_writer.stop()
+    unsubscribe_elapsed = time.perf_counter() - started
+
+    await database.db.close()
+    common.report('db_ops', {'ops': args.ops}, {
+        'subscribe_ops_per_s': args.ops / subscribe_elapsed,
+        'unsubscribe_ops_per_s': args.ops / unsubscribe_elapsed,
+        'stream_rows_per_s': streamed / stream_elapsed if stream_elapsed else 0.0,
+        'peak_rss_mb': common.peak_rss_mb(),
+    }, args.save)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--save', help='дописать результат в этот JSONL-файл')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
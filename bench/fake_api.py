@@ -0,0 +1,165 @@
+"""Локальная имитация Telegram Bot API для нагрузочных тестов
+
+Отвечает на методы отправки сообщений как настоящий сервер и умеет
+имитировать задержку сети, флуд-контроль (429 с retry_after) и
+пользователей, заблокировавших бота (403).
+
+Пример:
+    python bench/fake_api.py --port 8081 --latency-ms 40 --max-rate 30 --blocked-percent 20
+"""
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import deque
+
+from aiohttp import web
+
+SEND_METHODS = {'sendmessage', 'sendphoto', 'sendvideo', 'copymessage', 'sendmediagroup'}
+
+
+class FakeBotAPI:
+    """Обработчик запросов к поддельному Bot API"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, max_rate=0.0, retry_after=1,
+                 flood_percent=0.0, blocked_percent=0.0, seed=0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self.flood_percent = flood_percent
+        self.blocked_percent = blocked_percent
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1)
+        self.recent = deque()
+        self.stats = {'requests': 0, 'sent': 0, 'duplicates': 0, 'flood': 0, 'blocked': 0}
+        self.recipients = set()
+
+    def is_blocked(self, chat_id: int) -> bool:
+        # Один и тот же пользователь блокирует бота при каждом запуске теста
+        return (chat_id * 2654435761) % 10000 < self.blocked_percent * 100
+
+    def is_flooding(self) -> bool:
+        """Проверяет глобальный лимит скорости за последнюю секунду"""
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1.0:
+            self.recent.popleft()
+        if self.max_rate and len(self.recent) >= self.max_rate:
+            return True
+        if self.flood_percent and self.random.random() * 100 < self.flood_percent:
+            return True
+        self.recent.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats['requests'] += 1
+        method = request.match_info['method'].lower()
+        data = await request.post()
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if method == 'getme':
+            return web.json_response({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}})
+        if method not in SEND_METHODS:
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = int(data.get('chat_id', 0))
+        if self.is_flooding():
+            self.stats['flood'] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        if self.is_blocked(chat_id):
+            self.stats['blocked'] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 403,
+                'description': "Forbidden: bot was blocked by the user",
+            }, status=403)
+
+        self.stats['sent'] += 1
+        # Повторная отправка в тот же чат - дубль (в тестах одна рассылка на чат)
+        if chat_id in self.recipients:
+            self.stats['duplicates'] += 1
+        self.recipients.add(chat_id)
+        return web.json_response({'ok': True, 'result': self.make_result(method, chat_id)})
+
+    def make_result(self, method, chat_id):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if method == 'sendphoto':
+            message['photo'] = [{'file_id': 'fake-photo', 'file_unique_id': 'fake-photo',
+                                 'width': 1, 'height': 1}]
+        elif method == 'sendvideo':
+            message['video'] = {'file_id': 'fake-video', 'file_unique_id': 'fake-video',
+                                'width': 1, 'height': 1, 'duration': 1}
+        elif method == 'copymessage':
+            return {'message_id': message['message_id']}
+        elif method == 'sendmediagroup':
+            return [message]
+        else:
+            message['text'] = 'ok'
+        return message
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Параметры имитации, общие для сервера и тестов"""
+    parser.add_argument('--latency-ms', type=float, default=30.0, help='задержка каждого ответа')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='случайная добавка к задержке')
+    parser.add_argument('--max-rate', type=float, default=30.0,
+                        help='лимит запросов в секунду, сверх которого отвечать 429 (0 - без лимита)')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--flood-percent', type=float, default=0.0, help='доля случайных ответов 429')
+    parser.add_argument('--blocked-percent', type=float, default=0.0,
+                        help='доля пользователей, заблокировавших бота')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args) -> FakeBotAPI:
+    return FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        max_rate=args.max_rate,
+        retry_after=args.retry_after,
+        flood_percent=args.flood_percent,
+        blocked_percent=args.blocked_percent,
+        seed=args.seed,
+    )
+
+
+async def start_server(api: FakeBotAPI, host: str, port: int) -> web.AppRunner:
+    """Запускает сервер в текущем цикле событий"""
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"Поддельный Bot API: http://{args.host}:{args.port}")
+    web.run_app(from_arguments(args).make_app(), host=args.host, port=args.port,
+                access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Создает синтетическую базу newsletter.db для нагрузочных тестов
+
+Пример:
+    python bench/make_db.py --subscribers 100000 --db bench.db
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def make_db(path, subscribers, seed=0, batch=50000):
+    """Заполняет базу подписчиками со случайными, но воспроизводимыми ID"""
+    os.environ['DB_PATH'] = path
+    import database
+
+    await database.init_db()
+    rng = random.Random(seed)
+    # ID разнесены по диапазону, как у реальных пользователей Telegram
+    user_ids = rng.sample(range(10_000_000, 7_000_000_000), subscribers)
+    for start in range(0, subscribers, batch):
+        rows = [(user_id, f"user{user_id}", "Bench", None)
+                for user_id in user_ids[start:start + batch]]
+        await database.db.executemany('''
+        INSERT OR IGNORE INTO subscribers (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+        ''', rows)
+    await database.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+    started = time.perf_counter()
+    asyncio.run(make_db(args.db, args.subscribers, args.seed))
+    print(f"База {args.db}: {args.subscribers} подписчиков за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Измеряет скорость рассылки на поддельном Bot API
+
+Пример:
+    python bench/make_db.py --subscribers 10000 --db bench.db
+    python bench/run_broadcast.py --db bench.db --latency-ms 40 --blocked-percent 20 --save bench.jsonl
+
+Без --api поддельный сервер запускается в том же процессе с параметрами
+имитации из командной строки.
+"""
+import os
+import time
+import asyncio
+import argparse
+
+import common
+import fake_api
+
+
+class LatencyRecorder:
+    """Промежуточный слой сессии бота, замеряющий время каждого запроса"""
+
+    def __init__(self):
+        self.latencies = []
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+
+async def run(args):
+    common.setup_env(args.db)
+
+    server = None
+    api_url = args.api
+    if not api_url:
+        server = await fake_api.start_server(fake_api.from_arguments(args), '127.0.0.1', args.port)
+        api_url = f"http://127.0.0.1:{args.port}"
+
+    # Бот отправляет через ту же сессию с пулом соединений, что и в работе
+    os.environ['BOT_API_URL'] = api_url
+    import main
+    import database
+    from broadcast import TokenBucket
+
+    recorder = LatencyRecorder()
+    main.bot.session.middleware(recorder)
+    main.rate_limiter = TokenBucket(args.rate)
+    main.BROADCAST_WORKERS = args.workers
+
+    await database.init_db()
+    recipients = await database.count_subscribers()
+    message_id = await database.add_scheduled_message(
+        'text', 'Нагрузочный тест', None, None, time.strftime('%Y-%m-%d %H:%M:%S'), 0
+    )
+
+    started = time.perf_counter()
+    sent, failed = await main.send_message_to_subscribers(message_id)
+    elapsed = time.perf_counter() - started
+
+    await main.bot.session.close()
+    await database.db.close()
+    if server:
+        await server.cleanup()
+
+    latencies = recorder.latencies
+    common.report('broadcast', {
+        'subscribers': recipients,
+        'rate': args.rate,
+        'workers': args.workers,
+        'latency_ms': args.latency_ms,
+        'max_rate': args.max_rate,
+        'blocked_percent': args.blocked_percent,
+        'flood_percent': args.flood_percent,
+    }, {
+        'sent': sent,
+        'failed': failed,
+        'requests': len(latencies),
+        'elapsed_s': elapsed,
+        'msg_per_s': sent / elapsed if elapsed else 0.0,
+        'p50_latency_ms': common.percentile(latencies, 50) * 1000 if latencies else 0.0,
+        'p99_latency_ms': common.percentile(latencies, 99) * 1000 if latencies else 0.0,
+        'peak_rss_mb': common.peak_rss_mb(),
+    }, args.save)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--api', help='адрес уже запущенного Bot API (по умолчанию - встроенный)')
+    parser.add_argument('--port', type=int, default=8081, help='порт встроенного Bot API')
+    parser.add_argument('--rate', type=float, default=28.0, help='целевая скорость рассылки')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--save', help='дописать результат в этот JSONL-файл')
+    fake_api.add_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Проверяет шардированную рассылку несколькими процессами-воркерами
+
+Запускает поддельный Bot API, ставит рассылку в очередь как диспетчер,
+стартует несколько процессов bench/worker.py и ждет, пока рассылка
+не будет выполнена. С --kill-after один воркер принудительно завершается
+посреди работы, и его шарды должны забрать остальные.
+
+Пример:
+    python bench/make_db.py --subscribers 20000 --db bench.db
+    python bench/run_workers.py --db bench.db --workers 3 --rate 100 --kill-after 3
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import subprocess
+
+import common
+import fake_api
+
+
+async def run(args):
+    common.setup_env(args.db)
+    import database
+
+    api = fake_api.from_arguments(args)
+    server = await fake_api.start_server(api, '127.0.0.1', args.port)
+
+    # Диспетчер только фиксирует получателей и делит их на шарды
+    await database.init_db()
+    message_id = await database.add_scheduled_message(
+        'text', 'Нагрузочный тест', None, None, time.strftime('%Y-%m-%d %H:%M:%S'), 0
+    )
+    await database.start_deliveries(message_id)
+    await database.create_shards(message_id, args.shard_size)
+
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+    command = [sys.executable, worker_script, '--db', args.db, '--api', f"http://127.0.0.1:{args.port}",
+               '--rate', str(args.rate), '--lease', str(args.lease)]
+    workers = [subprocess.Popen(command, stderr=subprocess.DEVNULL) for _ in range(args.workers)]
+
+    started = time.perf_counter()
+    killed = False
+    try:
+        while True:
+            await asyncio.sleep(0.5)
+            if args.kill_after and not killed and time.perf_counter() - started > args.kill_after:
+                workers[0].kill()
+                killed = True
+                print(f"Воркер {workers[0].pid} принудительно завершен")
+            status = await database.db.fetchone(
+                'SELECT status FROM scheduled_messages WHERE id = ?', (message_id,)
+            )
+            if status[0] != 'sending':
+                break
+        elapsed = time.perf_counter() - started
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        await server.cleanup()
+
+    sent, failed = await database.count_deliveries(message_id)
+    await database.db.close()
+    common.report('workers', {
+        'workers': args.workers,
+        'rate_per_worker': args.rate,
+        'shard_size': args.shard_size,
+        'killed_worker': killed,
+        'latency_ms': args.latency_ms,
+        'max_rate': args.max_rate,
+    }, {
+        'sent': sent,
+        'failed': failed,
+        'api_sends': api.stats['sent'],
+        'duplicates': api.stats['duplicates'],
+        'elapsed_s': elapsed,
+        'msg_per_s': sent / elapsed if elapsed else 0.0,
+    }, args.save)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--rate', type=float, default=28.0, help='скорость рассылки каждого воркера')
+    parser.add_argument('--shard-size', type=int, default=1000)
+    parser.add_argument('--lease', type=float, default=5.0, help='срок аренды шарда, с')
+    parser.add_argument('--kill-after', type=float, default=0, help='через сколько секунд убить один воркер')
+    parser.add_argument('--save', help='дописать результат в этот JSONL-файл')
+    fake_api.add_arguments(parser)
+    parser.set_defaults(max_rate=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Процесс-воркер рассылок, отправляющий сообщения на поддельный Bot API
+
+Запускается из run_workers.py, но можно запустить и вручную:
+    python bench/worker.py --db bench.db --api http://127.0.0.1:8081
+"""
+import os
+import asyncio
+import argparse
+
+import common
+
+
+async def run(args):
+    common.setup_env(args.db)
+    os.environ['BOT_MODE'] = 'worker'
+    os.environ['BOT_API_URL'] = args.api
+    import main
+    from broadcast import TokenBucket
+
+    main.rate_limiter = TokenBucket(args.rate)
+    main.SHARD_LEASE_SECONDS = args.lease
+    await main.run_worker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--api', default='http://127.0.0.1:8081')
+    parser.add_argument('--rate', type=float, default=28.0, help='скорость рассылки этого воркера')
+    parser.add_argument('--lease', type=float, default=30.0, help='срок аренды шарда, с')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""HTTP-сессия бота с настраиваемым пулом соединений к Bot API
+
+Во время рассылки десятки воркеров отправляют запросы одновременно.
+Чтобы каждый запрос не открывал новое TCP/TLS-соединение, сессия держит
+пул соединений заданного размера и не закрывает простаивающие
+соединения keepalive секунд. Ответы DNS кэшируются.
+"""
+import json
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import ClientTimeout, TCPConnector
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.methods import GetMe
+
+from metrics import HTTP_CONNECTIONS, HTTP_POOL_LIMIT
+
+try:
+    import orjson
+except ImportError:
+    # orjson необязателен: без него используется стандартный json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+if orjson is not None:
+    def json_dumps(value: Any) -> str:
+        return orjson.dumps(value).decode()
+
+    json_loads: Callable[[str], Any] = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+
+def make_api_server(url: str = '', is_local: bool = False) -> TelegramAPIServer:
+    """Адрес Bot API: api.telegram.org или свой сервер (telegram-bot-api)
+
+    Локальный сервер (is_local=True) отдает файлы по путям на диске
+    и принимает файлы до 2000 МБ.
+    """
+    if not url:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(url.rstrip('/'), is_local=is_local)
+
+
+class PooledSession(AiohttpSession):
+    """Сессия aiogram с ограниченным пулом соединений и keep-alive
+
+    limit - всего соединений в пуле, limit_per_host - к одному хосту
+    (0 - без ограничения), keepalive - сколько секунд держать открытым
+    простаивающее соединение, dns_cache - сколько секунд помнить адрес
+    сервера. timeout - общее время запроса, connect_timeout - время на
+    установку соединения (включая ожидание свободного места в пуле).
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 0, keepalive: float = 60,
+                 dns_cache: Optional[int] = 300, connect_timeout: Optional[float] = 10,
+                 **kwargs: Any):
+        kwargs.setdefault('json_dumps', json_dumps)
+        kwargs.setdefault('json_loads', json_loads)
+        super().__init__(**kwargs)
+        self.connect_timeout = connect_timeout
+        self._connector_init.update(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive,
+            ttl_dns_cache=dns_cache,
+            use_dns_cache=dns_cache is not None,
+        )
+        HTTP_POOL_LIMIT.set(limit)
+        HTTP_CONNECTIONS.labels('in_use').set_function(lambda: self.pool_stats()['in_use'])
+        HTTP_CONNECTIONS.labels('idle').set_function(lambda: self.pool_stats()['idle'])
+
+    @property
+    def connector(self) -> Optional[TCPConnector]:
+        if self._session is None or self._session.closed:
+            return None
+        return self._session.connector
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Число занятых и простаивающих соединений в пуле"""
+        connector = self.connector
+        if connector is None:
+            return {'in_use': 0, 'idle': 0}
+        # У aiohttp нет публичного API для состояния пула
+        return {
+            'in_use': len(connector._acquired),
+            'idle': sum(len(conns) for conns in connector._conns.values()),
+        }
+
+    async def warm_up(self, bot, connections: int) -> int:
+        """Открывает до connections соединений заранее, например перед рассылкой
+
+        Одновременные легкие запросы getMe занимают каждый свое соединение,
+        после ответа они остаются в пуле. Возвращает число открытых соединений.
+        """
+        results = await asyncio.gather(
+            *(self.make_request(bot, GetMe()) for _ in range(connections)),
+            return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            logger.warning(f"Не удалось открыть соединений с Bot API: {len(errors)} ({errors[0]})")
+        return self.pool_stats()['idle']
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None):
+        # aiogram передает aiohttp только общее время запроса
+        total = self.timeout if timeout is None else timeout
+        return await super().make_request(
+            bot, method, timeout=ClientTimeout(total=total, connect=self.connect_timeout))
@@ -0,0 +1,337 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from batch_writer import BatchWriter
+from metrics import FLOOD_WAITS, FLOOD_WAIT_SECONDS, QUEUE_DEPTH, WORKERS_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+
+# Ошибки, после которых писать в чат бесполезно: пользователь удалил
+# аккаунт или чата больше нет (403 обрабатывается отдельно - это всегда блокировка)
+UNREACHABLE_ERRORS = ('chat not found', 'user is deactivated', 'peer_id_invalid')
+
+
+def is_unreachable(error: Exception) -> bool:
+    """Проверяет, что чат недоступен навсегда, а не из-за временного сбоя"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        message = error.message.lower()
+        return any(text in message for text in UNREACHABLE_ERRORS)
+    return False
+
+
+class BroadcastAborted(Exception):
+    """Ошибка, из-за которой рассылку бессмысленно продолжать
+
+    Например, удалено исходное сообщение рассылки копированием: тогда
+    каждая следующая отправка тоже завершилась бы ошибкой.
+    """
+
+
+class TokenBucket:
+    """Глобальный ограничитель скорости по алгоритму «корзина токенов»
+
+    Скорость подстраивается под ответы Telegram: при флуд-контроле (429)
+    она уменьшается в несколько раз, а затем понемногу восстанавливается
+    после каждой успешной отправки, но не выше исходной.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0, min_rate: float = 1.0,
+                 backoff: float = 0.5, recovery: float = 0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.backoff = backoff
+        self.recovery = recovery
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Ждёт, пока в корзине появится токен, и забирает его"""
+        async with self._lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    self._updated = time.monotonic()
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self):
+        """Плавно возвращает скорость к целевой после успешной отправки"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+
+    def on_flood(self, retry_after: float):
+        """Приостанавливает всю рассылку на retry_after секунд и снижает скорость"""
+        now = time.monotonic()
+        # Несколько воркеров могут получить 429 одновременно:
+        # скорость снижаем только один раз на каждую паузу
+        if now >= self._paused_until:
+            self.rate = max(self.min_rate, self.rate * self.backoff)
+            logger.warning(
+                f"Флуд-контроль Telegram: пауза {retry_after} с, "
+                f"скорость снижена до {self.rate:.1f} сообщ./с"
+            )
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._tokens = 0
+
+
+class ChatRateLimiter:
+    """Ограничитель частоты отправки в один и тот же чат"""
+
+    def __init__(self, interval: float = 1.0, max_chats: int = 10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed = OrderedDict()
+
+    async def acquire(self, chat_id: int):
+        """Ждёт, пока в чат снова можно будет отправить сообщение"""
+        now = time.monotonic()
+        allowed_at = self._next_allowed.pop(chat_id, now)
+        delay = allowed_at - now
+        self._next_allowed[chat_id] = max(allowed_at, now) + self.interval
+        # Старые записи вытесняем, чтобы словарь не рос бесконечно
+        while len(self._next_allowed) > self.max_chats:
+            self._next_allowed.popitem(last=False)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SharedUpload:
+    """Однократная загрузка файла для всей рассылки
+
+    Первый воркер загружает файл и получает его file_id, остальные ждут
+    окончания загрузки и отправляют уже готовый file_id. Если загрузка
+    не удалась, файл загрузит следующий воркер.
+    """
+
+    def __init__(self, file_id: Optional[str] = None):
+        self.file_id = file_id
+        self._lock = asyncio.Lock()
+
+    async def send(self, user_id: int, upload: Callable[[int], Awaitable[str]],
+                   send: Callable[[int, str], Awaitable]):
+        """Отправляет файл получателю, загружая его только при первой отправке"""
+        if self.file_id is None:
+            async with self._lock:
+                if self.file_id is None:
+                    self.file_id = await upload(user_id)
+                    return
+        await send(user_id, self.file_id)
+
+
+@dataclass
+class BroadcastResult:
+    """Итоги рассылки"""
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    flood_waits: int = 0
+    stopped: bool = False
+    aborted: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Фактическая скорость рассылки, сообщений в секунду"""
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+
+class Broadcaster:
+    """Рассылка с пулом конкурентных воркеров и ограничением скорости
+
+    Если передано событие stop, его установка останавливает рассылку:
+    воркеры не начинают новых отправок, а оставшиеся получатели не
+    получают результата и остаются неотправленными. Отправка, завершившаяся
+    BroadcastAborted, тоже устанавливает stop, а причина попадает в
+    result.aborted.
+    """
+
+    def __init__(self, send: Callable[[int], Awaitable], rate: float = 28.0,
+                 workers: int = 16, chat_interval: float = 1.0, max_retries: int = 5,
+                 on_result: Optional[Callable[[int, str], None]] = None,
+                 bucket: Optional[TokenBucket] = None,
+                 stop: Optional[asyncio.Event] = None):
+        self.send = send
+        self.on_result = on_result
+        self.stop = stop or asyncio.Event()
+        self.max_retries = max_retries
+        self.workers = workers
+        # Общий ограничитель позволяет нескольким рассылкам процесса
+        # вместе не превышать лимит Telegram
+        self.bucket = bucket or TokenBucket(rate)
+        self.chat_limiter = ChatRateLimiter(chat_interval)
+        self.result = BroadcastResult()
+
+    async def _produce(self, recipients: Union[Iterable[int], AsyncIterable[int]],
+                       queue: asyncio.Queue):
+        # Получатели могут поступать потоком из базы: очередь ограничена,
+        # поэтому следующая страница читается по мере освобождения воркеров
+        if hasattr(recipients, '__aiter__'):
+            async for user_id in recipients:
+                if self.stop.is_set():
+                    break
+                await queue.put(user_id)
+                QUEUE_DEPTH.inc()
+        else:
+            for user_id in recipients:
+                if self.stop.is_set():
+                    break
+                await queue.put(user_id)
+                QUEUE_DEPTH.inc()
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def _deliver(self, user_id: int):
+        """Отправляет сообщение одному получателю, переживая флуд-контроль"""
+        for _ in range(self.max_retries + 1):
+            await self.chat_limiter.acquire(user_id)
+            await self.bucket.acquire()
+            try:
+                await self.send(user_id)
+            except TelegramRetryAfter as e:
+                # Получатель не теряется: после общей паузы отправка повторяется
+                self.result.flood_waits += 1
+                FLOOD_WAITS.inc()
+                FLOOD_WAIT_SECONDS.inc(e.retry_after)
+                self.bucket.on_flood(e.retry_after)
+                continue
+            self.bucket.on_success()
+            return
+        raise RuntimeError(f"превышено число повторов после флуд-контроля ({self.max_retries})")
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            QUEUE_DEPTH.dec()
+            if self.stop.is_set():
+                continue
+            try:
+                with WORKERS_IN_FLIGHT.track_inprogress():
+                    await self._deliver(user_id)
+                self.result.sent += 1
+                status = 'sent'
+            except BroadcastAborted as e:
+                # Получатель остается неотправленным, остальные воркеры
+                # останавливаются перед следующей отправкой
+                if self.result.aborted is None:
+                    logger.error(f"Рассылка прервана: {e}")
+                    self.result.aborted = str(e)
+                self.stop.set()
+                continue
+            except Exception as e:
+                self.result.failed += 1
+                if is_unreachable(e):
+                    logger.info(f"Пользователь {user_id} недоступен для рассылки: {e}")
+                    self.result.blocked += 1
+                    status = 'blocked'
+                else:
+                    logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                    status = 'failed'
+            if self.on_result:
+                self.on_result(user_id, status)
+
+    async def run(self, recipients: Union[Iterable[int], AsyncIterable[int]]) -> BroadcastResult:
+        """Рассылает сообщение всем получателям и возвращает итоги"""
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        self.result = BroadcastResult()
+        producer = asyncio.ensure_future(self._produce(recipients, queue))
+        workers = [asyncio.ensure_future(self._work(queue)) for _ in range(self.workers)]
+        try:
+            try:
+                await producer
+            except Exception:
+                # Получатели не читаются (например, ошибка базы): уже взятых
+                # в очередь воркеры отправляют до конца, затем ошибка идет выше
+                for _ in range(self.workers):
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+                raise
+            await asyncio.gather(*workers)
+        finally:
+            # При отмене воркеры не должны остаться ждать очередь
+            for task in (producer, *workers):
+                task.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            # Прерванная рассылка оставляет получателей в очереди
+            while not queue.empty():
+                if queue.get_nowait() is not None:
+                    QUEUE_DEPTH.dec()
+        self.result.finished_at = time.monotonic()
+        self.result.stopped = self.stop.is_set()
+        logger.info(
+            f"Рассылка {'остановлена' if self.result.stopped else 'завершена'}: отправлено {self.result.sent}, ошибок {self.result.failed} "
+            f"(из них недоступных чатов {self.result.blocked}), "
+            f"пауз из-за флуд-контроля {self.result.flood_waits}, "
+            f"скорость {self.result.rate:.1f} сообщ./с"
+        )
+        return self.result
+
+
+class DeliveryLog(BatchWriter):
+    """Буфер результатов доставки, который сбрасывается пачками
+
+    Пачка записывается функцией save, когда набирается batch_size результатов
+    или проходит interval секунд. При выходе из контекста записывается
+    остаток буфера.
+    """
+
+    description = 'результатов доставки'
+
+    def __init__(self, save: Callable[[list], Awaitable], batch_size: int = 500,
+                 interval: float = 1.0):
+        super().__init__(interval, batch_size)
+        self._save = save
+        self._buffer = []
+
+    def record(self, user_id: int, status: str):
+        """Запоминает результат доставки одному получателю"""
+        self._buffer.append((user_id, status))
+        self._added(len(self._buffer))
+
+    def _take(self):
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _restore(self, batch):
+        # Более ранние результаты остаются в начале буфера
+        self._buffer[:0] = batch
+
+    async def _write(self, batch):
+        await self._save(batch)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
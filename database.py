@@ -0,0 +1,1110 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional
+
+from batch_writer import BatchWriter
+from metrics import BROADCAST_START_LAG, DB_CALL_SECONDS, timed_db_call
+
+logger = logging.getLogger(__name__)
+
+# Путь к файлу базы данных
+DB_PATH = os.getenv('DB_PATH', 'newsletter.db')
+
+# Настройки SQLite: журнал WAL позволяет читать во время записи,
+# а synchronous=NORMAL убирает fsync на каждый коммит (в режиме WAL это безопасно)
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Подписки и отписки записываются в базу пачками: раз в SUBSCRIBER_FLUSH_MS
+# миллисекунд или по накоплении SUBSCRIBER_FLUSH_ROWS изменений
+SUBSCRIBER_FLUSH_MS = int(os.getenv('SUBSCRIBER_FLUSH_MS', '200'))
+SUBSCRIBER_FLUSH_ROWS = int(os.getenv('SUBSCRIBER_FLUSH_ROWS', '1000'))
+
+# Границы диапазона ID чатов в Telegram: начальное значение для постраничного
+# перебора и верхняя граница последнего шарда рассылки
+MIN_USER_ID = -2 ** 63
+MAX_USER_ID = 2 ** 63 - 1
+
+
+class Database:
+    """Долгоживущее подключение к SQLite, работающее в отдельном потоке
+
+    Все запросы выполняются в одном выделенном потоке, поэтому не блокируют
+    цикл событий и не требуют блокировок вокруг подключения.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self):
+        # isolation_level=None - автокоммит; транзакции открываются явно
+        self._conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+        for pragma in PRAGMAS:
+            self._conn.execute(pragma)
+
+    def open(self):
+        """Запускает поток базы данных и открывает подключение"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='db',
+                initializer=self._connect
+            )
+
+    async def close(self):
+        """Закрывает подключение и останавливает поток базы данных"""
+        if self._executor is None:
+            return
+        await self.run(lambda conn: conn.close())
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        self._conn = None
+
+    async def run(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполняет func(conn) в потоке базы данных"""
+        self.open()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._conn))
+
+    async def transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполняет func(conn) внутри одной транзакции"""
+        def run_in_transaction(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        return await self.run(run_in_transaction)
+
+    async def execute(self, sql: str, params: Iterable = ()) -> sqlite3.Cursor:
+        return await self.run(lambda conn: conn.execute(sql, params))
+
+    async def executemany(self, sql: str, seq: Iterable[Iterable]):
+        await self.transaction(lambda conn: conn.executemany(sql, seq))
+
+    async def fetchone(self, sql: str, params: Iterable = ()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Iterable = ()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+
+class SubscriberCache:
+    """Множество ID подписчиков в памяти
+
+    Загружается один раз при запуске и обновляется при каждой подписке
+    и отписке, поэтому проверка подписки и подсчет подписчиков не обращаются
+    к базе. Вместе с множеством хранится контрольная сумма ID для сверки с базой.
+    """
+
+    def __init__(self):
+        self._ids = set()
+        self._checksum = 0
+        self.loaded = False
+        # Изменения, сделанные во время загрузки: (user_id, подписан ли)
+        self._changes = None
+
+    def __contains__(self, user_id):
+        return user_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, user_id):
+        if self._changes is not None:
+            self._changes.append((user_id, True))
+        if user_id not in self._ids:
+            self._ids.add(user_id)
+            self._checksum += user_id
+
+    def discard(self, user_id):
+        if self._changes is not None:
+            self._changes.append((user_id, False))
+        if user_id in self._ids:
+            self._ids.remove(user_id)
+            self._checksum -= user_id
+
+    @timed_db_call
+    async def load(self):
+        """Загружает ID всех подписчиков из базы
+
+        Подписки и отписки, сделанные, пока идет загрузка, запоминаются
+        и применяются к загруженному множеству, поэтому не теряются.
+        """
+        self._changes = []
+        try:
+            # Изменения, сделанные до начала загрузки, должны попасть в базу
+            await subscriber_writer.flush()
+            ids = set()
+            async for user_id in iter_subscribers(page_size=10000):
+                ids.add(user_id)
+            for user_id, subscribed in self._changes:
+                if subscribed:
+                    ids.add(user_id)
+                else:
+                    ids.discard(user_id)
+        finally:
+            self._changes = None
+        self._ids = ids
+        self._checksum = sum(ids)
+        self.loaded = True
+        logger.info(f"Кэш подписчиков загружен: {len(ids)}")
+
+    @timed_db_call
+    async def verify(self):
+        """Сверяет кэш с базой и перезагружает его при расхождении"""
+        await subscriber_writer.flush()
+        count, checksum = await db.fetchone(
+            'SELECT COUNT(*), COALESCE(SUM(user_id), 0) FROM subscribers WHERE active = 1'
+        )
+        if count == len(self._ids) and checksum == self._checksum:
+            return True
+        logger.warning(
+            f"Кэш подписчиков расходится с базой "
+            f"({len(self._ids)} в кэше, {count} в базе), перезагружаем"
+        )
+        await self.load()
+        return False
+
+
+class SubscriberWriter(BatchWriter):
+    """Отложенная запись подписок и отписок в базу пачками
+
+    Изменения по одному пользователю схлопываются (остается последнее),
+    а накопленная пачка записывается одной транзакцией. Кэш подписчиков
+    обновляется сразу, поэтому проверки подписки не ждут записи. Так же
+    пачками записывается время последней активности подписчиков.
+    """
+
+    description = 'подписчиков'
+
+    def __init__(self, interval: float, max_rows: int):
+        super().__init__(interval, max_rows)
+        # user_id -> (username, first_name, last_name, language_code) или None для отписки
+        self._pending = {}
+        # user_id -> (время последней активности, language_code)
+        self._active = {}
+
+    def add(self, user_id, username, first_name, last_name, language_code=None):
+        self._pending[user_id] = (username, first_name, last_name, language_code)
+        self._check_size()
+
+    def remove(self, user_id):
+        self._pending[user_id] = None
+        self._check_size()
+
+    def touch(self, user_id, language_code=None):
+        """Запоминает, что пользователь только что писал боту"""
+        self._active[user_id] = (time.time(), language_code)
+        self._check_size()
+
+    def _check_size(self):
+        self._added(max(len(self._pending), len(self._active)))
+
+    def _take(self):
+        batch, active = self._pending, self._active
+        self._pending, self._active = {}, {}
+        return (batch, active) if batch or active else None
+
+    def _restore(self, batch):
+        batch, active = batch
+        for user_id, data in batch.items():
+            self._pending.setdefault(user_id, data)
+        for user_id, data in active.items():
+            self._active.setdefault(user_id, data)
+
+    @timed_db_call
+    async def _write(self, batch):
+        """Записывает пачку изменений одной транзакцией"""
+        batch, active = batch
+        inserts = [(user_id, *data) for user_id, data in batch.items() if data is not None]
+        deletes = [(user_id,) for user_id, data in batch.items() if data is None]
+        touches = [
+            (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(active_at)), language_code, user_id)
+            for user_id, (active_at, language_code) in active.items()
+        ]
+
+        def write(conn):
+            # Повторная подписка заново активирует пользователя, но сохраняет
+            # дату первой подписки, активность и теги
+            conn.executemany('''
+            INSERT INTO subscribers
+                (user_id, username, first_name, last_name, language_code, activated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                language_code = COALESCE(excluded.language_code, language_code),
+                activated_at = CASE WHEN active = 1 THEN activated_at ELSE excluded.activated_at END,
+                active = 1,
+                deactivated_at = NULL
+            ''', inserts)
+            conn.executemany('DELETE FROM subscribers WHERE user_id = ?', deletes)
+            conn.executemany('''
+            UPDATE subscribers
+            SET last_active_at = ?, language_code = COALESCE(?, language_code)
+            WHERE user_id = ?
+            ''', touches)
+
+        await db.transaction(write)
+
+
+def add_column(conn, table, column, definition):
+    """Добавляет столбец в существующую таблицу, если его еще нет"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def migrate_inactive_subscribers(conn):
+    """Пользователи, заблокировавшие бота, помечаются неактивными
+    и больше не попадают в рассылки"""
+    add_column(conn, 'subscribers', 'active', 'INTEGER DEFAULT 1')
+    add_column(conn, 'subscribers', 'deactivated_at', 'TIMESTAMP')
+    add_column(conn, 'scheduled_messages', 'skipped_inactive', 'INTEGER DEFAULT 0')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_subscribers_inactive
+    ON subscribers (deactivated_at) WHERE active = 0
+    ''')
+
+def migrate_scheduled_index(conn):
+    """Индекс для выборки рассылок по статусу в порядке времени отправки"""
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_scheduled_status_time
+    ON scheduled_messages (status, scheduled_time)
+    ''')
+
+def migrate_fsm_states(conn):
+    """Таблица состояний FSM, общая для всех процессов бота"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        expires_at REAL
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_fsm_states_expires
+    ON fsm_states (expires_at)
+    ''')
+
+def migrate_media_groups(conn):
+    """Части альбомов: рассылка с типом media_group хранит список файлов"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS media_group_items (
+        message_id INTEGER,
+        position INTEGER,
+        media_type TEXT,
+        file_id TEXT,
+        caption TEXT,
+        PRIMARY KEY (message_id, position)
+    ) WITHOUT ROWID
+    ''')
+
+def migrate_copy_source(conn):
+    """Исходное сообщение в чате администратора для рассылки копированием"""
+    add_column(conn, 'scheduled_messages', 'source_chat_id', 'INTEGER')
+    add_column(conn, 'scheduled_messages', 'source_message_id', 'INTEGER')
+
+def migrate_segments(conn):
+    """Атрибуты подписчиков для сегментированных рассылок
+
+    Язык и даты хранятся в таблице подписчиков, теги - в отдельной таблице,
+    где по первичному ключу (tag, user_id) подписчики тега выбираются поиском
+    по индексу. Индексы частичные: в рассылки попадают только активные.
+    """
+    add_column(conn, 'subscribers', 'language_code', 'TEXT')
+    add_column(conn, 'subscribers', 'last_active_at', 'TIMESTAMP')
+    add_column(conn, 'scheduled_messages', 'segment', 'TEXT')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS subscriber_tags (
+        tag TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (tag, user_id)
+    ) WITHOUT ROWID
+    ''')
+    for column in ('language_code', 'subscribed_at', 'last_active_at'):
+        conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_subscribers_{column}
+        ON subscribers ({column}) WHERE active = 1
+        ''')
+
+def migrate_broadcast_start(conn):
+    """Время подготовки и фактического начала рассылки"""
+    add_column(conn, 'scheduled_messages', 'prepared_at', 'TIMESTAMP')
+    add_column(conn, 'scheduled_messages', 'started_at', 'TIMESTAMP')
+    add_column(conn, 'scheduled_messages', 'start_lag', 'REAL')
+
+def migrate_subscriber_activation(conn):
+    """Время, когда подписчик стал активным (подписался или подписался снова)
+
+    По нему подготовленная заранее рассылка добирает получателей в момент
+    начала: дата первой подписки при повторной подписке не меняется.
+    """
+    add_column(conn, 'subscribers', 'activated_at', 'TIMESTAMP')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_subscribers_activated_at
+    ON subscribers (activated_at) WHERE active = 1
+    ''')
+
+def migrate_drop_job_store(conn):
+    """Удаляет таблицу прежнего хранилища задач планировщика
+
+    Задачи рассылок восстанавливаются при запуске из scheduled_messages.
+    """
+    conn.execute('DROP TABLE IF EXISTS apscheduler_jobs')
+
+def migrate_media_group_entities(conn):
+    """Разметка подписей частей альбома (жирный текст, ссылки...) в JSON
+
+    Подписи отправляются с этой разметкой и без parse_mode, поэтому символы
+    вроде < в тексте подписи не ломают отправку.
+    """
+    add_column(conn, 'media_group_items', 'caption_entities', 'TEXT')
+
+# Миграции схемы по порядку; номер версии - позиция в списке, начиная с 1.
+# Новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    migrate_inactive_subscribers,
+    migrate_scheduled_index,
+    migrate_fsm_states,
+    migrate_media_groups,
+    migrate_copy_source,
+    migrate_segments,
+    migrate_broadcast_start,
+    migrate_subscriber_activation,
+    migrate_drop_job_store,
+    migrate_media_group_entities,
+]
+
+def apply_migrations(conn):
+    """Применяет миграции, которых еще нет в базе (версия в PRAGMA user_version)"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        logger.info(f"Применена миграция схемы #{number}: {migration.__name__}")
+
+
+db = Database(DB_PATH)
+subscriber_cache = SubscriberCache()
+subscriber_writer = SubscriberWriter(SUBSCRIBER_FLUSH_MS / 1000, SUBSCRIBER_FLUSH_ROWS)
+
+
+@timed_db_call
+async def init_db():
+    """Инициализация базы данных и создание таблиц, если их нет"""
+    def create_tables(conn):
+        # Создаем таблицу подписчиков
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscribers (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            subscribed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Создаем таблицу для запланированных сообщений
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_type TEXT,
+            message_content TEXT,
+            media_id TEXT,
+            caption TEXT,
+            scheduled_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by INTEGER,
+            status TEXT DEFAULT 'pending'
+        )
+        ''')
+
+        # Создаем таблицу доставок: состояние рассылки для каждого получателя
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            message_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID
+        ''')
+
+        # Создаем таблицу загруженных в Telegram локальных файлов
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT,
+            mtime REAL,
+            media_type TEXT,
+            file_id TEXT,
+            PRIMARY KEY (path, mtime, media_type)
+        ) WITHOUT ROWID
+        ''')
+
+        # Создаем таблицу шардов: диапазоны получателей рассылки, которые
+        # воркеры забирают в аренду и продлевают ее, пока работают
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS shards (
+            message_id INTEGER,
+            shard INTEGER,
+            lo INTEGER,
+            hi INTEGER,
+            status TEXT DEFAULT 'pending',
+            worker_id TEXT,
+            lease_until REAL DEFAULT 0,
+            PRIMARY KEY (message_id, shard)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_shards_status
+        ON shards (status, lease_until)
+        ''')
+
+        apply_migrations(conn)
+
+    await db.transaction(create_tables)
+    logger.info("База данных инициализирована")
+
+@timed_db_call
+async def add_subscriber(user_id, username, first_name, last_name, language_code=None):
+    """Добавляет пользователя в список подписчиков"""
+    subscriber_writer.add(user_id, username, first_name, last_name, language_code)
+    subscriber_cache.add(user_id)
+    if not subscriber_writer.running:
+        await subscriber_writer.flush()
+    logger.info(f"Пользователь {user_id} ({username}) подписался на рассылку")
+
+@timed_db_call
+async def remove_subscriber(user_id):
+    """Удаляет пользователя из списка подписчиков"""
+    subscriber_writer.remove(user_id)
+    subscriber_cache.discard(user_id)
+    if not subscriber_writer.running:
+        await subscriber_writer.flush()
+    logger.info(f"Пользователь {user_id} отписался от рассылки")
+
+def segment_filter(segment, active=True):
+    """Условие SQL на таблицу subscribers для получателей сегмента
+
+    segment - словарь с необязательными ключами: tags и languages (списки,
+    подходит любое из значений), subscribed_after и subscribed_before
+    (даты ГГГГ-ММ-ДД), active_days (писал боту за это число дней).
+    Возвращает (условие, параметры); пустой сегмент - все активные подписчики.
+    С active=False условие выбирает неактивных подписчиков того же сегмента.
+    """
+    conditions = ['active = 1' if active else 'active = 0']
+    params = []
+    segment = segment or {}
+    if segment.get('tags'):
+        placeholders = ', '.join('?' * len(segment['tags']))
+        conditions.append(f'user_id IN (SELECT user_id FROM subscriber_tags WHERE tag IN ({placeholders}))')
+        params.extend(segment['tags'])
+    if segment.get('languages'):
+        placeholders = ', '.join('?' * len(segment['languages']))
+        conditions.append(f'language_code IN ({placeholders})')
+        params.extend(segment['languages'])
+    if segment.get('subscribed_after'):
+        conditions.append('subscribed_at >= ?')
+        params.append(segment['subscribed_after'])
+    if segment.get('subscribed_before'):
+        conditions.append('subscribed_at < ?')
+        params.append(segment['subscribed_before'])
+    if segment.get('active_days'):
+        # Граница считается в момент запроса, а не при создании рассылки
+        conditions.append('last_active_at >= ?')
+        params.append(time.strftime('%Y-%m-%d %H:%M:%S',
+                                    time.gmtime(time.time() - segment['active_days'] * 86400)))
+    return ' AND '.join(conditions), params
+
+@timed_db_call
+async def count_segment(segment):
+    """Возвращает число подписчиков в сегменте"""
+    where, params = segment_filter(segment)
+    row = await db.fetchone(f'SELECT COUNT(*) FROM subscribers WHERE {where}', params)
+    return row[0]
+
+@timed_db_call
+async def add_subscriber_tag(tag, user_ids):
+    """Назначает тег пользователям"""
+    await db.executemany(
+        'INSERT OR IGNORE INTO subscriber_tags (tag, user_id) VALUES (?, ?)',
+        [(tag, user_id) for user_id in user_ids])
+
+@timed_db_call
+async def remove_subscriber_tag(tag, user_ids):
+    """Снимает тег с пользователей"""
+    await db.executemany(
+        'DELETE FROM subscriber_tags WHERE tag = ? AND user_id = ?',
+        [(tag, user_id) for user_id in user_ids])
+
+@timed_db_call
+async def get_tag_counts(limit=10):
+    """Возвращает самые частые теги активных подписчиков: список (тег, число)"""
+    return await db.fetchall('''
+    SELECT t.tag, COUNT(*)
+    FROM subscriber_tags t
+    JOIN subscribers s ON s.user_id = t.user_id AND s.active = 1
+    GROUP BY t.tag
+    ORDER BY COUNT(*) DESC, t.tag
+    LIMIT ?
+    ''', (limit,))
+
+async def iter_subscribers(page_size=1000, segment=None):
+    """Постранично перебирает ID подписчиков (всех или сегмента), не загружая
+    весь список в память"""
+    # Постраничный перебор по ключу: каждая страница - поиск по индексу,
+    # в отличие от OFFSET, который заново проходит все предыдущие строки
+    where, params = segment_filter(segment)
+    last_id = MIN_USER_ID
+    while True:
+        with DB_CALL_SECONDS.labels('iter_subscribers').time():
+            rows = await db.fetchall(f'''
+            SELECT user_id FROM subscribers
+            WHERE user_id > ? AND {where}
+            ORDER BY user_id
+            LIMIT ?
+            ''', (last_id, *params, page_size))
+        for row in rows:
+            yield row[0]
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+@timed_db_call
+async def count_subscribers():
+    """Возвращает количество подписчиков"""
+    if subscriber_cache.loaded:
+        return len(subscriber_cache)
+    row = await db.fetchone('SELECT COUNT(*) FROM subscribers WHERE active = 1')
+    return row[0]
+
+@timed_db_call
+async def is_subscribed(user_id):
+    """Проверяет, подписан ли пользователь"""
+    if subscriber_cache.loaded:
+        return user_id in subscriber_cache
+    row = await db.fetchone('SELECT 1 FROM subscribers WHERE user_id = ? AND active = 1', (user_id,))
+    return row is not None
+
+@timed_db_call
+async def add_scheduled_message(message_type, message_content, media_id, caption, scheduled_time, created_by,
+                                media_items=None, source=None, segment=None):
+    """Добавляет запланированное сообщение в базу данных
+
+    Для альбома (message_type='media_group') media_items - список его частей
+    в виде (тип, file_id, подпись, разметка подписи - список словарей
+    MessageEntity или None). Для рассылки копированием
+    (message_type='copy') source - (чат, ID сообщения) исходного сообщения.
+    segment - условия отбора получателей (см. segment_filter), None - всем.
+    """
+    source_chat_id, source_message_id = source or (None, None)
+    segment_json = json.dumps(segment) if segment else None
+
+    def insert(conn):
+        cursor = conn.execute('''
+        INSERT INTO scheduled_messages
+        (message_type, message_content, media_id, caption, scheduled_time, created_by,
+         source_chat_id, source_message_id, segment)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (message_type, message_content, media_id, caption, scheduled_time, created_by,
+              source_chat_id, source_message_id, segment_json))
+        message_id = cursor.lastrowid
+        if media_items:
+            conn.executemany('''
+            INSERT INTO media_group_items
+                (message_id, position, media_type, file_id, caption, caption_entities)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(message_id, position, media_type, file_id, caption,
+                   json.dumps(entities) if entities else None)
+                  for position, (media_type, file_id, caption, entities) in enumerate(media_items)])
+        return message_id
+
+    message_id = await db.transaction(insert)
+    logger.info(f"Добавлено запланированное сообщение #{message_id} на {scheduled_time}")
+    return message_id
+
+@timed_db_call
+async def get_media_group_items(message_id):
+    """Возвращает части альбома по порядку: список (тип, file_id, подпись,
+    разметка подписи или None)"""
+    rows = await db.fetchall('''
+    SELECT media_type, file_id, caption, caption_entities
+    FROM media_group_items
+    WHERE message_id = ?
+    ORDER BY position
+    ''', (message_id,))
+    return [(media_type, file_id, caption, json.loads(entities) if entities else None)
+            for media_type, file_id, caption, entities in rows]
+
+@timed_db_call
+async def get_scheduled_messages(status='pending', limit=-1):
+    """Получает список запланированных сообщений с указанным статусом
+    (не больше limit ближайших, по умолчанию - все)"""
+    return await db.fetchall('''
+    SELECT id, message_type, message_content, media_id, caption, scheduled_time
+    FROM scheduled_messages
+    WHERE status = ?
+    ORDER BY scheduled_time
+    LIMIT ?
+    ''', (status, limit))
+
+@timed_db_call
+async def get_scheduled_message(message_id, status='pending'):
+    """Получает одно запланированное сообщение по ID, если у него указанный статус
+
+    Возвращает (id, message_type, message_content, media_id, caption,
+    scheduled_time, source_chat_id, source_message_id, created_by).
+    """
+    return await db.fetchone('''
+    SELECT id, message_type, message_content, media_id, caption, scheduled_time,
+           source_chat_id, source_message_id, created_by
+    FROM scheduled_messages
+    WHERE id = ? AND status = ?
+    ''', (message_id, status))
+
+@timed_db_call
+async def count_scheduled_messages(status='pending'):
+    """Возвращает количество сообщений с указанным статусом"""
+    row = await db.fetchone(
+        'SELECT COUNT(*) FROM scheduled_messages WHERE status = ?', (status,))
+    return row[0]
+
+@timed_db_call
+async def update_message_status(message_id, status):
+    """Обновляет статус запланированного сообщения"""
+    await db.execute('''
+    UPDATE scheduled_messages
+    SET status = ?
+    WHERE id = ?
+    ''', (status, message_id))
+    logger.info(f"Обновлен статус сообщения #{message_id} на {status}")
+
+@timed_db_call
+async def change_message_status(message_id, current_statuses, status):
+    """Меняет статус сообщения, только если текущий статус - один из current_statuses
+
+    Возвращает True, если статус изменен.
+    """
+    placeholders = ', '.join('?' * len(current_statuses))
+    cursor = await db.execute(f'''
+    UPDATE scheduled_messages
+    SET status = ?
+    WHERE id = ? AND status IN ({placeholders})
+    ''', (status, message_id, *current_statuses))
+    if cursor.rowcount:
+        logger.info(f"Обновлен статус сообщения #{message_id} на {status}")
+    return cursor.rowcount > 0
+
+@timed_db_call
+async def expire_missed_messages(deadline):
+    """Переводит рассылки, запланированные раньше deadline, в статус 'missed'"""
+    cursor = await db.execute('''
+    UPDATE scheduled_messages
+    SET status = 'missed'
+    WHERE status = 'pending' AND scheduled_time < ?
+    ''', (deadline,))
+    if cursor.rowcount:
+        logger.info(f"Пропущенных рассылок отмечено: {cursor.rowcount}")
+    return cursor.rowcount
+
+def message_segment_filter(conn, message_id, active=True):
+    """Условие segment_filter для сегмента рассылки message_id"""
+    segment = conn.execute(
+        'SELECT segment FROM scheduled_messages WHERE id = ?', (message_id,)).fetchone()[0]
+    return segment_filter(json.loads(segment) if segment else None, active)
+
+def snapshot_recipients(conn, message_id, since=None):
+    """Добавляет подписчиков из сегмента рассылки в ее список доставок
+
+    Получатели отбираются внутри базы одним запросом, без выгрузки в память.
+    С since добавляются только ставшие активными (подписавшиеся впервые
+    или снова) начиная с этого времени. Возвращает число добавленных получателей.
+    """
+    where, params = message_segment_filter(conn, message_id)
+    if since is not None:
+        where += ' AND activated_at >= ?'
+        params.append(since)
+    cursor = conn.execute(f'''
+    INSERT OR IGNORE INTO deliveries (message_id, user_id)
+    SELECT ?, user_id FROM subscribers WHERE {where}
+    ''', (message_id, *params))
+
+    if since is None:
+        # Запоминаем, сколько отправок сэкономлено на неактивных подписчиках
+        # из сегмента рассылки
+        inactive_where, inactive_params = message_segment_filter(conn, message_id, active=False)
+        conn.execute(f'''
+        UPDATE scheduled_messages
+        SET skipped_inactive = (SELECT COUNT(*) FROM subscribers WHERE {inactive_where})
+        WHERE id = ?
+        ''', (*inactive_params, message_id))
+    return cursor.rowcount
+
+@timed_db_call
+async def prepare_deliveries(message_id):
+    """Заранее фиксирует получателей запланированной рассылки
+
+    Рассылка остается в статусе 'pending', поэтому воркеры ее не берут.
+    В назначенное время start_deliveries переводит ее в 'sending' и добавляет
+    ставших активными после подготовки, а отписавшихся и неактивных пропускает
+    iter_pending_deliveries. Возвращает число получателей или None, если
+    рассылка уже подготовлена или начата.
+    """
+    await subscriber_writer.flush()
+
+    def prepare(conn):
+        cursor = conn.execute('''
+        UPDATE scheduled_messages
+        SET prepared_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'pending' AND prepared_at IS NULL
+        ''', (message_id,))
+        if not cursor.rowcount:
+            return None
+        return snapshot_recipients(conn, message_id)
+
+    created = await db.transaction(prepare)
+    if created is not None:
+        logger.info(f"Для рассылки #{message_id} заранее зафиксировано получателей: {created}")
+    return created
+
+@timed_db_call
+async def start_deliveries(message_id):
+    """Фиксирует список получателей рассылки, если она ещё не начиналась
+
+    Отставание начала от назначенного времени записывает record_first_send,
+    когда уходит первое сообщение рассылки.
+    """
+    # Список получателей должен учитывать еще не записанные подписки
+    await subscriber_writer.flush()
+
+    def snapshot(conn):
+        row = conn.execute('''
+        SELECT prepared_at FROM scheduled_messages
+        WHERE id = ? AND status = 'pending'
+        ''', (message_id,)).fetchone()
+
+        # Рассылка уже начиналась раньше - продолжаем с сохраненного списка
+        if row is None:
+            return None
+        prepared_at = row[0]
+        conn.execute('''
+        UPDATE scheduled_messages
+        SET status = 'sending'
+        WHERE id = ?
+        ''', (message_id,))
+        if not prepared_at:
+            return snapshot_recipients(conn, message_id), prepared_at
+        # У подготовленной рассылки список уже есть: добавляем только ставших
+        # активными после подготовки (по индексу на activated_at)
+        return snapshot_recipients(conn, message_id, since=prepared_at), prepared_at
+
+    result = await db.transaction(snapshot)
+    if result is None:
+        return
+    created, prepared_at = result
+    if prepared_at:
+        logger.info(f"Рассылка #{message_id} начата по заранее подготовленному списку, "
+                    f"новых получателей: {created}")
+    else:
+        logger.info(f"Для рассылки #{message_id} зафиксировано получателей: {created}")
+
+@timed_db_call
+async def record_first_send(message_id, sent_at):
+    """Запоминает, когда ушло первое сообщение рассылки, и отставание
+    от назначенного времени
+
+    sent_at - время отправки (time.time()). Повторные вызовы (следующие
+    шарды, другие процессы) ничего не меняют.
+    """
+    def record(conn):
+        row = conn.execute('''
+        SELECT scheduled_time FROM scheduled_messages
+        WHERE id = ? AND started_at IS NULL
+        ''', (message_id,)).fetchone()
+        if row is None:
+            return None
+        lag = sent_at - time.mktime(time.strptime(row[0], '%Y-%m-%d %H:%M:%S'))
+        conn.execute('''
+        UPDATE scheduled_messages
+        SET started_at = ?, start_lag = ?
+        WHERE id = ?
+        ''', (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(sent_at)), lag, message_id))
+        return lag
+
+    lag = await db.transaction(record)
+    if lag is None:
+        return
+    BROADCAST_START_LAG.observe(max(lag, 0.0))
+    logger.info(f"Первое сообщение рассылки #{message_id} отправлено, "
+                f"отставание от назначенного времени {lag:.3f} с")
+
+async def iter_pending_deliveries(message_id, page_size=1000, lo=MIN_USER_ID, hi=MAX_USER_ID):
+    """Постранично перебирает получателей, которым сообщение еще не отправлено
+
+    lo и hi ограничивают диапазон ID получателей (lo < user_id <= hi).
+    Получатели, которые с момента фиксации списка отписались или стали
+    неактивными, пропускаются и получают статус доставки 'skipped'.
+    """
+    def fetch_page(conn, last_id):
+        # Подписчик ищется по первичному ключу для каждой строки страницы,
+        # поэтому проверка не перебирает всех подписчиков
+        rows = conn.execute('''
+        SELECT d.user_id, COALESCE(s.active, 0)
+        FROM deliveries d
+        LEFT JOIN subscribers s ON s.user_id = d.user_id
+        WHERE d.message_id = ? AND d.status = 'pending' AND d.user_id > ? AND d.user_id <= ?
+        ORDER BY d.user_id
+        LIMIT ?
+        ''', (message_id, last_id, hi, page_size)).fetchall()
+        if rows and not all(active for _, active in rows):
+            conn.execute('''
+            UPDATE deliveries
+            SET status = 'skipped'
+            WHERE message_id = ? AND status = 'pending' AND user_id > ? AND user_id <= ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM subscribers s
+                  WHERE s.user_id = deliveries.user_id AND s.active = 1
+              )
+            ''', (message_id, last_id, rows[-1][0]))
+        return rows
+
+    last_id = lo
+    while True:
+        with DB_CALL_SECONDS.labels('iter_pending_deliveries').time():
+            rows = await db.run(lambda conn: fetch_page(conn, last_id))
+        for user_id, active in rows:
+            if active:
+                yield user_id
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+def mark_sent(conn, message_id):
+    """Отмечает идущую рассылку выполненной; True, если статус изменен"""
+    cursor = conn.execute('''
+    UPDATE scheduled_messages
+    SET status = 'sent'
+    WHERE id = ? AND status = 'sending'
+    ''', (message_id,))
+    return cursor.rowcount > 0
+
+@timed_db_call
+async def create_shards(message_id, shard_size):
+    """Делит получателей рассылки на шарды по shard_size человек
+
+    Повторный вызов для той же рассылки шардов не меняет, но отмечает
+    рассылку выполненной, если все ее шарды уже готовы (например, их
+    доделали, пока рассылка стояла на паузе). Рассылка без получателей
+    сразу считается выполненной.
+    """
+    def split(conn):
+        shards, left = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(status != 'done'), 0)
+        FROM shards
+        WHERE message_id = ?
+        ''', (message_id,)).fetchone()
+        if shards:
+            if not left:
+                mark_sent(conn, message_id)
+            return None
+        # Первый ID каждого шарда - за один проход по первичному ключу
+        starts = [row[0] for row in conn.execute('''
+        SELECT user_id FROM (
+            SELECT user_id, ROW_NUMBER() OVER (ORDER BY user_id) AS rn
+            FROM deliveries
+            WHERE message_id = ?
+        )
+        WHERE (rn - 1) % ? = 0
+        ''', (message_id, shard_size))]
+        if not starts:
+            mark_sent(conn, message_id)
+            return 0
+        # Шард - полуинтервал (lo, hi]: от предыдущего начала до следующего
+        bounds = [MIN_USER_ID] + [start - 1 for start in starts[1:]] + [MAX_USER_ID]
+        conn.executemany('''
+        INSERT INTO shards (message_id, shard, lo, hi)
+        VALUES (?, ?, ?, ?)
+        ''', [(message_id, i, bounds[i], bounds[i + 1]) for i in range(len(starts))])
+        return len(starts)
+
+    created = await db.transaction(split)
+    if created is not None:
+        logger.info(f"Рассылка #{message_id} разделена на шарды: {created}")
+
+@timed_db_call
+async def claim_shard(worker_id, lease_seconds, message_id=None):
+    """Берет в аренду свободный шард или шард, аренда которого истекла
+
+    Возвращает (message_id, shard, lo, hi, message_type, message_content,
+    media_id, caption, source_chat_id, source_message_id) или None, если
+    свободных шардов нет.
+    """
+    def claim(conn):
+        now = time.time()
+        row = conn.execute('''
+        SELECT s.message_id, s.shard, s.lo, s.hi,
+               m.message_type, m.message_content, m.media_id, m.caption,
+               m.source_chat_id, m.source_message_id
+        FROM shards s
+        JOIN scheduled_messages m ON m.id = s.message_id
+        WHERE s.status = 'pending' AND s.lease_until < ? AND m.status = 'sending'
+          AND (? IS NULL OR s.message_id = ?)
+        ORDER BY s.message_id, s.shard
+        LIMIT 1
+        ''', (now, message_id, message_id)).fetchone()
+        if row is None:
+            return None
+        conn.execute('''
+        UPDATE shards
+        SET worker_id = ?, lease_until = ?
+        WHERE message_id = ? AND shard = ?
+        ''', (worker_id, now + lease_seconds, row[0], row[1]))
+        return row
+
+    shard = await db.transaction(claim)
+    if shard is not None:
+        logger.info(f"Воркер {worker_id} взял шард {shard[1]} рассылки #{shard[0]}")
+    return shard
+
+@timed_db_call
+async def renew_shard_lease(message_id, shard, worker_id, lease_seconds):
+    """Продлевает аренду шарда
+
+    Возвращает False, если шард уже забрал другой воркер или рассылку
+    приостановили либо отменили.
+    """
+    cursor = await db.execute('''
+    UPDATE shards
+    SET lease_until = ?
+    WHERE message_id = ? AND shard = ? AND worker_id = ? AND status = 'pending'
+      AND EXISTS (SELECT 1 FROM scheduled_messages WHERE id = ? AND status = 'sending')
+    ''', (time.time() + lease_seconds, message_id, shard, worker_id, message_id))
+    return cursor.rowcount > 0
+
+@timed_db_call
+async def release_shard(message_id, shard, worker_id):
+    """Возвращает недоделанный шард в очередь, не дожидаясь конца аренды"""
+    await db.execute('''
+    UPDATE shards
+    SET lease_until = 0
+    WHERE message_id = ? AND shard = ? AND worker_id = ? AND status = 'pending'
+    ''', (message_id, shard, worker_id))
+
+@timed_db_call
+async def finish_shard(message_id, shard, worker_id):
+    """Отмечает шард выполненным; True, если это был последний шард рассылки"""
+    def finish(conn):
+        conn.execute('''
+        UPDATE shards
+        SET status = 'done'
+        WHERE message_id = ? AND shard = ? AND worker_id = ?
+        ''', (message_id, shard, worker_id))
+        left = conn.execute('''
+        SELECT COUNT(*) FROM shards
+        WHERE message_id = ? AND status != 'done'
+        ''', (message_id,)).fetchone()[0]
+        if left:
+            return False
+        return mark_sent(conn, message_id)
+
+    done = await db.transaction(finish)
+    if done:
+        logger.info(f"Обновлен статус сообщения #{message_id} на sent")
+    return done
+
+@timed_db_call
+async def update_deliveries(message_id, results):
+    """Сохраняет пачку результатов доставки одной транзакцией
+
+    Получатели со статусом 'blocked' (заблокировали бота, удалили аккаунт)
+    в той же транзакции помечаются неактивными подписчиками.
+    """
+    blocked = [(user_id,) for user_id, status in results if status == 'blocked']
+
+    def write(conn):
+        conn.executemany('''
+        UPDATE deliveries
+        SET status = ?
+        WHERE message_id = ? AND user_id = ?
+        ''', [(status, message_id, user_id) for user_id, status in results])
+        conn.executemany('''
+        UPDATE subscribers
+        SET active = 0, deactivated_at = CURRENT_TIMESTAMP
+        WHERE user_id = ? AND active = 1
+        ''', blocked)
+
+    await db.transaction(write)
+    for (user_id,) in blocked:
+        subscriber_cache.discard(user_id)
+    if blocked:
+        logger.info(f"Неактивными помечены подписчики, недоступные для рассылки: {len(blocked)}")
+
+@timed_db_call
+async def count_deliveries(message_id):
+    """Возвращает число успешных и неудачных доставок рассылки"""
+    return await db.fetchone('''
+    SELECT
+        COALESCE(SUM(status = 'sent'), 0),
+        COALESCE(SUM(status IN ('failed', 'blocked')), 0)
+    FROM deliveries
+    WHERE message_id = ?
+    ''', (message_id,))
+
+@timed_db_call
+async def get_delivery_progress(message_id):
+    """Возвращает (статус рассылки, ожидают, отправлено, ошибок) или None"""
+    return await db.fetchone('''
+    SELECT
+        m.status,
+        COALESCE(SUM(d.status = 'pending'), 0),
+        COALESCE(SUM(d.status = 'sent'), 0),
+        COALESCE(SUM(d.status IN ('failed', 'blocked')), 0)
+    FROM scheduled_messages m
+    LEFT JOIN deliveries d ON d.message_id = m.id
+    WHERE m.id = ?
+    GROUP BY m.id
+    ''', (message_id,))
+
+@timed_db_call
+async def get_inactive_report():
+    """Возвращает число неактивных подписчиков и сэкономленных на них отправок"""
+    inactive = await db.fetchone('SELECT COUNT(*) FROM subscribers WHERE active = 0')
+    reclaimed = await db.fetchone('SELECT COALESCE(SUM(skipped_inactive), 0) FROM scheduled_messages')
+    return inactive[0], reclaimed[0]
+
+@timed_db_call
+async def get_cached_file_id(path, mtime, media_type):
+    """Возвращает file_id ранее загруженного локального файла"""
+    row = await db.fetchone('''
+    SELECT file_id FROM media_cache
+    WHERE path = ? AND mtime = ? AND media_type = ?
+    ''', (path, mtime, media_type))
+    return row[0] if row else None
+
+@timed_db_call
+async def save_cached_file_id(path, mtime, media_type, file_id):
+    """Запоминает file_id загруженного локального файла"""
+    await db.execute('''
+    INSERT OR REPLACE INTO media_cache (path, mtime, media_type, file_id)
+    VALUES (?, ?, ?, ?)
+    ''', (path, mtime, media_type, file_id))
+    logger.info(f"Файл {path} загружен в Telegram, file_id сохранен")
@@ -0,0 +1,145 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from batch_writer import BatchWriter
+from database import Database
+from metrics import timed_db_call
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage, BatchWriter):
+    """Хранилище состояний FSM в базе данных бота
+
+    Состояния переживают перезапуск бота. Кэш, буфер записи и блокировки
+    aiogram действуют внутри одного процесса, поэтому обновления должен
+    принимать один процесс (воркеры рассылок диалогов не ведут).
+    Записи копятся в буфере и сбрасываются пачкой раз в flush_interval
+    секунд (или по накоплении flush_rows изменений).
+    Прочитанные из базы состояния кэшируются на cache_seconds секунд:
+    за это время обработка одного обновления читает состояние несколько раз.
+    Состояния, которые не менялись дольше ttl секунд, считаются истекшими.
+    """
+
+    description = 'состояний FSM'
+
+    def __init__(self, db: Database, ttl: float = 86400, flush_interval: float = 0.2,
+                 flush_rows: int = 500, cache_seconds: float = 1.0, cache_size: int = 1000,
+                 json_dumps: Callable[[Any], str] = json.dumps,
+                 json_loads: Callable[[str], Any] = json.loads):
+        BatchWriter.__init__(self, flush_interval, flush_rows)
+        self.db = db
+        self.ttl = ttl
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self.json_dumps = json_dumps
+        self.json_loads = json_loads
+        # ключ -> (состояние, данные в JSON, время чтения)
+        self._cache = OrderedDict()
+        # ключ -> (состояние, данные в JSON, срок хранения) еще не записанных изменений
+        self._pending = {}
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        # business_connection_id появился в aiogram 3.5
+        return ':'.join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, 'business_connection_id', None), key.destiny))
+
+    async def _load(self, key: str):
+        """Возвращает (состояние, данные в JSON) с учетом буфера и кэша"""
+        if key in self._pending:
+            return self._pending[key][:2]
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[2] < self.cache_seconds:
+            return cached[:2]
+        row = await self._fetch(key)
+        entry = row if row is not None else (None, '{}')
+        self._remember(key, *entry)
+        return entry
+
+    @timed_db_call
+    async def _fetch(self, key: str):
+        return await self.db.fetchone('''
+        SELECT state, data FROM fsm_states
+        WHERE key = ? AND expires_at > ?
+        ''', (key, time.time()))
+
+    def _remember(self, key: str, state: Optional[str], data: str):
+        self._cache[key] = (state, data, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _store(self, key: str, state: Optional[str], data: str):
+        self._pending[key] = (state, data, time.time() + self.ttl)
+        self._remember(key, state, data)
+        self._added(len(self._pending))
+        if not self.running:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self._key(key)
+        _, data = await self._load(key)
+        await self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self._key(key)
+        state, _ = await self._load(key)
+        await self._store(key, state, self.json_dumps(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return self.json_loads(data)
+
+    def _take(self):
+        batch, self._pending = self._pending, {}
+        return batch
+
+    def _restore(self, batch):
+        for key, entry in batch.items():
+            self._pending.setdefault(key, entry)
+
+    @timed_db_call
+    async def _write(self, batch):
+        """Записывает пачку изменений одной транзакцией"""
+        # Пустое состояние без данных (после state.clear()) просто удаляется
+        upserts = [(key, state, data, expires_at)
+                   for key, (state, data, expires_at) in batch.items()
+                   if state is not None or data != '{}']
+        deletes = [(key,) for key, (state, data, _) in batch.items()
+                   if state is None and data == '{}']
+
+        def write(conn):
+            conn.executemany('''
+            INSERT OR REPLACE INTO fsm_states (key, state, data, expires_at)
+            VALUES (?, ?, ?, ?)
+            ''', upserts)
+            conn.executemany('DELETE FROM fsm_states WHERE key = ?', deletes)
+
+        await self.db.transaction(write)
+
+    @timed_db_call
+    async def delete_expired(self):
+        """Удаляет из базы истекшие состояния"""
+        cursor = await self.db.execute(
+            'DELETE FROM fsm_states WHERE expires_at <= ?', (time.time(),))
+        if cursor.rowcount:
+            logger.info(f"Удалено истекших состояний FSM: {cursor.rowcount}")
+
+    async def close(self) -> None:
+        """Останавливает периодическую запись и сбрасывает остаток буфера
+
+        Подключение к базе общее с остальным ботом и здесь не закрывается.
+        """
+        await self.stop()
@@ -1,27 +1,45 @@
 import os
+import time
+import signal
+import socket
 import logging
-import sqlite3
+import secrets
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Union, Dict, Any, List
 
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, FSInputFile
-from aiogram.filters import Command, CommandStart
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto, InputMediaVideo, MessageEntity
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.markdown import hbold, hitalic
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_MISSED
 from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from dotenv import load_dotenv
 
-# Загружаем переменные среды из .env файла
+# Загружаем переменные среды из .env файла. Это нужно сделать до импорта
+# модулей бота: database читает свои настройки (DB_PATH и другие) при импорте
 load_dotenv()
 
+import database
+import metrics
+from bot_session import PooledSession, json_dumps, json_loads, make_api_server
+from fsm_storage import SQLiteStorage
+from broadcast import BroadcastAborted, Broadcaster, DeliveryLog, SharedUpload, TokenBucket
+from middlewares import (ActivityMiddleware, ConcurrencyLimitMiddleware, HandlerTimingMiddleware,
+                         ThrottlingMiddleware)
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -36,235 +54,698 @@ ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(',')))
 if not ADMIN_IDS:
     logger.warning("Список администраторов пуст! Добавьте ID администраторов в .env файл")
 
+# Параметры рассылки: целевая скорость (сообщений в секунду), число воркеров
+# и минимальный интервал между сообщениями в один чат (в секундах)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '28'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '16'))
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', '1.0'))
+
+# Части альбома приходят отдельными сообщениями: альбом считается полученным,
+# если за MEDIA_GROUP_WAIT секунд не пришло новых частей
+MEDIA_GROUP_WAIT = float(os.getenv('MEDIA_GROUP_WAIT', '1.0'))
+
+# Как часто (в секундах) обновлять сообщение с ходом рассылки
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '5'))
+# После стольких ошибок подряд сообщение о ходе рассылки перестает обновляться
+PROGRESS_MAX_ERRORS = 10
+
+# Состояния диалогов (FSM) хранятся в базе: через сколько секунд без
+# изменений состояние забывается и как часто изменения записываются
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', '86400'))
+FSM_FLUSH_MS = int(os.getenv('FSM_FLUSH_MS', '200'))
+
+# Сколько секунд после назначенного времени рассылку еще можно отправить,
+# если бот был выключен в этот момент. Более старые рассылки получают
+# статус 'missed'
+SCHEDULE_MISFIRE_GRACE_SECONDS = int(os.getenv('SCHEDULE_MISFIRE_GRACE_SECONDS', '900'))
+
+# За сколько секунд до назначенного времени готовить рассылку: фиксировать
+# получателей, загружать файл и открывать соединения с Bot API (0 - не готовить)
+PREWARM_SECONDS = int(os.getenv('PREWARM_SECONDS', '60'))
+
+# Как часто (в минутах) сверять кэш подписчиков с базой данных
+SUBSCRIBER_CACHE_CHECK_MINUTES = int(os.getenv('SUBSCRIBER_CACHE_CHECK_MINUTES', '60'))
+
+# Режим приема обновлений: polling (по умолчанию) или webhook.
+# В режиме вебхука бот поднимает aiohttp-сервер, который обычно ставят
+# за обратный прокси. Если WEBHOOK_URL не задан, вебхук в Telegram
+# не регистрируется (удобно для локальной проверки)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Сколько обновлений может обрабатываться одновременно и сколько секунд
+# ждать их завершения при остановке
+HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', '100'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '30'))
+
+# Защита от флуда командами: не больше THROTTLE_USER_LIMIT обновлений от
+# одного пользователя и THROTTLE_GLOBAL_LIMIT от всех (0 - без ограничения)
+# за THROTTLE_WINDOW секунд; одинаковые команды одного пользователя чаще
+# раза в THROTTLE_DUPLICATE_SECONDS секунд обрабатываются один раз.
+# На администраторов ограничения не действуют
+THROTTLE_WINDOW = float(os.getenv('THROTTLE_WINDOW', '10'))
+THROTTLE_USER_LIMIT = int(os.getenv('THROTTLE_USER_LIMIT', '20'))
+THROTTLE_GLOBAL_LIMIT = int(os.getenv('THROTTLE_GLOBAL_LIMIT', '0'))
+THROTTLE_DUPLICATE_SECONDS = float(os.getenv('THROTTLE_DUPLICATE_SECONDS', '2'))
+
+# Шардирование рассылок: получатели делятся на шарды по SHARD_SIZE человек,
+# которые процессы-воркеры берут в аренду на SHARD_LEASE_SECONDS секунд и
+# продлевают, пока работают. Шарды упавшего воркера забирают другие.
+# BROADCAST_ROLE=local - бот рассылает сам (и помогает другим воркерам),
+# BROADCAST_ROLE=dispatcher - бот только ставит рассылки в очередь,
+# а отправляют их процессы, запущенные с BOT_MODE=worker
+BROADCAST_ROLE = os.getenv('BROADCAST_ROLE', 'local')
+SHARD_SIZE = int(os.getenv('SHARD_SIZE', '5000'))
+SHARD_LEASE_SECONDS = float(os.getenv('SHARD_LEASE_SECONDS', '30'))
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '1.0'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+# Адрес HTTP-сервера метрик Prometheus (http://METRICS_HOST:METRICS_PORT/metrics).
+# По умолчанию сервер не запускается; нескольким процессам на одной
+# машине нужны разные порты
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Адрес Bot API: пусто - api.telegram.org, иначе свой сервер telegram-bot-api
+# (BOT_API_LOCAL=1, если он запущен в режиме --local)
+BOT_API_URL = os.getenv('BOT_API_URL', '')
+BOT_API_LOCAL = os.getenv('BOT_API_LOCAL', '0') == '1'
+
+# Пул HTTP-соединений с Bot API: размер пула (всего и к одному хосту,
+# 0 - без ограничения), сколько секунд держать простаивающее соединение
+# открытым, сколько секунд кэшировать DNS и таймауты запроса в секундах
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '0'))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', '60'))
+HTTP_DNS_CACHE = int(os.getenv('HTTP_DNS_CACHE', '300'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=PooledSession(
+        api=make_api_server(BOT_API_URL, BOT_API_LOCAL),
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive=HTTP_KEEPALIVE,
+        dns_cache=HTTP_DNS_CACHE,
+        timeout=HTTP_TIMEOUT,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+    ),
+    parse_mode="HTML"
+)
+storage = SQLiteStorage(database.db, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_MS / 1000,
+                        json_dumps=json_dumps, json_loads=json_loads)
+# Обновления одного пользователя обрабатываются по очереди, чтобы части
+# альбома не затирали друг друга в данных FSM. Middleware FSM регистрируется
+# ниже, после ограничения частоты: иначе состояние читалось бы из базы
+# и для отброшенных обновлений
+dp = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation(), disable_fsm=True)
 router = Router()
 dp.include_router(router)
 
-# Инициализация планировщика
-scheduler = AsyncIOScheduler()
+# Слишком частые обновления отбрасываются до того, как займут место
+# в обработке и дойдут до базы
+dp.update.outer_middleware(ThrottlingMiddleware(
+    window=THROTTLE_WINDOW,
+    user_limit=THROTTLE_USER_LIMIT,
+    global_limit=THROTTLE_GLOBAL_LIMIT,
+    duplicate_interval=THROTTLE_DUPLICATE_SECONDS,
+    exempt=ADMIN_IDS,
+    commands=('start', 'subscribe', 'unsubscribe', 'status', 'send_message',
+              'progress', 'stats', 'tag', 'untag'),
+))
+dp.update.outer_middleware(dp.fsm)
+
+# Ограничение числа одновременно обрабатываемых обновлений
+concurrency_limiter = ConcurrencyLimitMiddleware(HANDLER_CONCURRENCY)
+dp.update.outer_middleware(concurrency_limiter)
+
+# Время последней активности и язык подписчиков - для сегментов рассылок
+dp.update.outer_middleware(ActivityMiddleware(database.subscriber_writer.touch))
+
+# Длительность каждого обработчика попадает в метрики
+router.message.middleware(HandlerTimingMiddleware())
+router.callback_query.middleware(HandlerTimingMiddleware())
+
+# Инициализация планировщика. Задачи хранятся только в памяти: при запуске
+# они восстанавливаются из таблицы рассылок (по индексу на статус и время),
+# поэтому планировщик не обращается к базе из цикла событий
+scheduler = AsyncIOScheduler(
+    job_defaults={
+        'misfire_grace_time': SCHEDULE_MISFIRE_GRACE_SECONDS,
+        'coalesce': True
+    }
+)
+
+# Общий для всех рассылок процесса ограничитель скорости
+rate_limiter = TokenBucket(BROADCAST_RATE)
+
+# Ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+background_tasks = set()
+
+# События остановки рассылок, шарды которых отправляет этот процесс
+broadcast_stops = {}
+
+# Функции отправки, подготовленные заранее для запланированных рассылок
+prepared_senders = {}
+
+# Заголовки сообщения о ходе рассылки для каждого ее статуса
+PROGRESS_TITLES = {
+    'pending': "⏳ Рассылка готовится",
+    'sending': "📤 Рассылка идет",
+    'paused': "⏸ Рассылка на паузе",
+    'sent': "✅ Рассылка завершена!",
+    'cancelled': "⏹ Рассылка отменена",
+    'failed': "❌ Рассылка прервана ошибкой",
+    'source_deleted': "❌ Рассылка остановлена: исходное сообщение удалено",
+}
+
+# Кнопки управления рассылкой: из каких статусов и в какой переводят
+BROADCAST_ACTIONS = {
+    'pause': (('sending',), 'paused', "Рассылка приостановлена"),
+    'resume': (('paused',), 'sending', "Рассылка продолжена"),
+    'cancel': (('pending', 'sending', 'paused'), 'cancelled', "Рассылка отменена"),
+}
 
 # Определение состояний FSM для сценариев отправки
 class SendMessageStates(StatesGroup):
+    choosing_audience = State()
+    waiting_for_segment = State()
     waiting_for_message = State()
     waiting_for_schedule_time = State()
     confirm_sending = State()
 
-# Функции для работы с базой данных
-def init_db():
-    """Инициализация базы данных и создание таблиц, если их нет"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    # Создаем таблицу подписчиков
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS subscribers (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        subscribed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Создаем таблицу для запланированных сообщений
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS scheduled_messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        message_type TEXT,
-        message_content TEXT,
-        media_id TEXT,
-        caption TEXT,
-        scheduled_time TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        created_by INTEGER,
-        status TEXT DEFAULT 'pending'
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("База данных инициализирована")
+# Подсказка по условиям сегмента рассылки
+SEGMENT_HELP = (
+    "Укажите условия через пробел:\n"
+    "tag=vip,beta - подписчики хотя бы с одним из тегов\n"
+    "lang=ru,uk - язык Telegram подписчика\n"
+    "since=01.01.2024 - подписались не раньше даты\n"
+    "before=01.06.2024 - подписались раньше даты\n"
+    "active=30 - писали боту за последние 30 дней\n\n"
+    "Например: lang=ru active=30"
+)
 
-def add_subscriber(user_id, username, first_name, last_name):
-    """Добавляет пользователя в список подписчиков"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    c.execute('''
-    INSERT OR REPLACE INTO subscribers (user_id, username, first_name, last_name)
-    VALUES (?, ?, ?, ?)
-    ''', (user_id, username, first_name, last_name))
-    
-    conn.commit()
-    conn.close()
-    logger.info(f"Пользователь {user_id} ({username}) подписался на рассылку")
+# Вспомогательные функции
+def is_admin(user_id):
+    """Проверяет, является ли пользователь администратором"""
+    return user_id in ADMIN_IDS
 
-def remove_subscriber(user_id):
-    """Удаляет пользователя из списка подписчиков"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    c.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
-    
-    conn.commit()
-    conn.close()
-    logger.info(f"Пользователь {user_id} отписался от рассылки")
+def normalize_tag(tag):
+    """Приводит тег к единому виду: без # и в нижнем регистре"""
+    return tag.strip().lstrip('#').lower()
 
-def get_all_subscribers():
-    """Возвращает список всех подписчиков"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    c.execute('SELECT user_id FROM subscribers')
-    subscribers = [row[0] for row in c.fetchall()]
-    
-    conn.close()
-    return subscribers
+def parse_segment(text):
+    """Разбирает условия сегмента вида 'tag=vip lang=ru,uk active=30'
 
-def count_subscribers():
-    """Возвращает количество подписчиков"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    c.execute('SELECT COUNT(*) FROM subscribers')
-    count = c.fetchone()[0]
-    
-    conn.close()
-    return count
+    Возвращает словарь для database.segment_filter; при ошибке - ValueError.
+    """
+    segment = {}
+    for part in text.split():
+        key, _, value = part.partition('=')
+        values = [item for item in value.split(',') if item]
+        if not values:
+            raise ValueError(part)
+        key = key.lower()
+        if key == 'tag':
+            segment['tags'] = [normalize_tag(item) for item in values]
+        elif key == 'lang':
+            segment['languages'] = [item.lower() for item in values]
+        elif key == 'since':
+            segment['subscribed_after'] = datetime.strptime(value, "%d.%m.%Y").strftime("%Y-%m-%d")
+        elif key == 'before':
+            segment['subscribed_before'] = datetime.strptime(value, "%d.%m.%Y").strftime("%Y-%m-%d")
+        elif key == 'active' and value.isdigit() and int(value) > 0:
+            segment['active_days'] = int(value)
+        else:
+            raise ValueError(part)
+    if not segment:
+        raise ValueError(text)
+    return segment
 
-def is_subscribed(user_id):
-    """Проверяет, подписан ли пользователь"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
-    
-    c.execute('SELECT COUNT(*) FROM subscribers WHERE user_id = ?', (user_id,))
-    count = c.fetchone()[0]
-    
-    conn.close()
-    return count > 0
+def describe_segment(segment):
+    """Описание сегмента для администратора"""
+    if not segment:
+        return "все подписчики"
+    parts = []
+    if segment.get('tags'):
+        parts.append(f"теги: {', '.join(segment['tags'])}")
+    if segment.get('languages'):
+        parts.append(f"язык: {', '.join(segment['languages'])}")
+    if segment.get('subscribed_after'):
+        since = datetime.strptime(segment['subscribed_after'], "%Y-%m-%d")
+        parts.append(f"подписались с {since.strftime('%d.%m.%Y')}")
+    if segment.get('subscribed_before'):
+        before = datetime.strptime(segment['subscribed_before'], "%Y-%m-%d")
+        parts.append(f"подписались до {before.strftime('%d.%m.%Y')}")
+    if segment.get('active_days'):
+        parts.append(f"активны за {segment['active_days']} дн.")
+    return "; ".join(parts)
+
+async def count_recipients(user_data):
+    """Число получателей рассылки из данных диалога
+
+    Для сегмента используется число, посчитанное при его выборе.
+    """
+    if user_data.get('segment'):
+        return user_data.get('segment_count', 0)
+    return await database.count_subscribers()
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей, которая отменяется при остановке бота"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
+    return task
+
+def finish_background_task(task):
+    """Забывает завершенную фоновую задачу и пишет в лог ее ошибку"""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка в фоновой задаче {task.get_coro().__qualname__}: {task.exception()!r}",
+                     exc_info=task.exception())
+
+async def upload_media(message_type, local_path, chat_id, caption=None):
+    """Загружает локальный файл в Telegram, отправляя его в chat_id
 
-def add_scheduled_message(message_type, message_content, media_id, caption, scheduled_time, created_by):
-    """Добавляет запланированное сообщение в базу данных"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
+    Полученный file_id сохраняется в базе и возвращается.
+    """
+    mtime = os.path.getmtime(local_path)
+    send_media = {'photo': bot.send_photo, 'video': bot.send_video}[message_type]
+    sent_message = await send_media(chat_id, FSInputFile(local_path), caption=caption)
+    if message_type == 'photo':
+        file_id = sent_message.photo[-1].file_id
+    else:
+        file_id = sent_message.video.file_id
+    await database.save_cached_file_id(local_path, mtime, message_type, file_id)
+    return file_id
+
+async def build_sender(message_type, content, media_id=None, caption=None, media_items=None, source=None):
+    """Возвращает функцию, отправляющую сообщение одному получателю
+
+    Способ отправки выбирается один раз на всю рассылку, а не для каждого
+    получателя. Для альбома media_items - его части в виде (тип, file_id,
+    подпись, разметка подписи), для копирования source - (чат, ID сообщения) исходного сообщения.
+    """
+    if message_type == 'copy':
+        # Сообщение копируется из чата администратора: в запросе только ссылки
+        # на исходное сообщение, а форматирование и любой тип контента сохраняются
+        from_chat_id, source_message_id = source
+        
+        async def deliver(user_id):
+            try:
+                await bot.copy_message(user_id, from_chat_id, source_message_id)
+            except TelegramBadRequest as e:
+                # Исходное сообщение удалили: остальным получателям его тоже
+                # не скопировать, поэтому рассылка останавливается целиком
+                if 'message to copy not found' in e.message.lower():
+                    raise BroadcastAborted(
+                        f"исходное сообщение {source_message_id} в чате {from_chat_id} удалено") from e
+                raise
     
-    c.execute('''
-    INSERT INTO scheduled_messages 
-    (message_type, message_content, media_id, caption, scheduled_time, created_by)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ''', (message_type, message_content, media_id, caption, scheduled_time, created_by))
+    elif message_type == 'media_group':
+        # Альбом уходит каждому получателю одним запросом sendMediaGroup.
+        # Подпись передается с исходной разметкой и без parse_mode бота:
+        # иначе форматирование теряется, а текст вроде "<100" ломает HTML
+        media_classes = {'photo': InputMediaPhoto, 'video': InputMediaVideo}
+        album = [
+            media_classes[item_type](
+                media=file_id,
+                caption=item_caption or None,
+                caption_entities=[MessageEntity(**entity) for entity in entities] if entities else None,
+                parse_mode=None
+            )
+            for item_type, file_id, item_caption, entities in media_items
+        ]
+        
+        async def deliver(user_id):
+            await bot.send_media_group(user_id, album)
     
-    message_id = c.lastrowid
+    elif message_type == 'text':
+        async def deliver(user_id):
+            await bot.send_message(user_id, content)
     
-    conn.commit()
-    conn.close()
-    logger.info(f"Добавлено запланированное сообщение #{message_id} на {scheduled_time}")
-    return message_id
-
-def get_scheduled_messages(status='pending'):
-    """Получает список запланированных сообщений с указанным статусом"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
+    else:
+        send_media = {'photo': bot.send_photo, 'video': bot.send_video}[message_type]
+        
+        if media_id.startswith('file://'):
+            # Локальный файл загружается в Telegram один раз, а остальным
+            # получателям уходит полученный file_id. Он же сохраняется в базе,
+            # чтобы следующие рассылки этого файла обходились без загрузки
+            local_path = media_id.replace('file://', '')
+            cached_file_id = await database.get_cached_file_id(
+                local_path, os.path.getmtime(local_path), message_type)
+            upload = SharedUpload(cached_file_id)
+            
+            async def send_file_id(user_id, file_id):
+                await send_media(user_id, file_id, caption=caption)
+            
+            async def upload_file(user_id):
+                return await upload_media(message_type, local_path, user_id, caption)
+            
+            async def deliver(user_id):
+                await upload.send(user_id, upload_file, send_file_id)
+        else:
+            # Если это file_id
+            async def deliver(user_id):
+                await send_media(user_id, media_id, caption=caption)
     
-    c.execute('''
-    SELECT id, message_type, message_content, media_id, caption, scheduled_time
-    FROM scheduled_messages
-    WHERE status = ?
-    ORDER BY scheduled_time
-    ''', (status,))
+    send_seconds = metrics.SEND_SECONDS.labels(message_type)
     
-    messages = c.fetchall()
+    async def send(user_id):
+        with send_seconds.time():
+            await deliver(user_id)
     
-    conn.close()
-    return messages
+    return send
+
+async def process_shard(shard):
+    """Рассылает сообщение получателям одного шарда, продлевая его аренду
 
-def update_message_status(message_id, status):
-    """Обновляет статус запланированного сообщения"""
-    conn = sqlite3.connect('newsletter.db')
-    c = conn.cursor()
+    Возвращает False, если аренду перехватил другой воркер.
+    """
+    (message_id, shard_no, lo, hi, message_type, content, media_id, caption,
+     source_chat_id, source_message_id) = shard
+    send = prepared_senders.get(message_id)
+    if send is None:
+        media_items = None
+        if message_type == 'media_group':
+            media_items = await database.get_media_group_items(message_id)
+        send = await build_sender(message_type, content, media_id, caption, media_items,
+                                  (source_chat_id, source_message_id))
+    recipients = database.iter_pending_deliveries(message_id, lo=lo, hi=hi)
     
-    c.execute('''
-    UPDATE scheduled_messages
-    SET status = ?
-    WHERE id = ?
-    ''', (status, message_id))
+    # Результаты доставки пишутся в базу пачками, чтобы после сбоя
+    # рассылку можно было продолжить с того же места
+    async def save(results):
+        await database.update_deliveries(message_id, results)
     
-    conn.commit()
-    conn.close()
-    logger.info(f"Обновлен статус сообщения #{message_id} на {status}")
+    # Пауза или отмена рассылки останавливает отправку сразу после
+    # текущих сообщений воркеров
+    stop = broadcast_stops.setdefault(message_id, asyncio.Event())
+    lease_lost = False
+    first_send = True
+    async with DeliveryLog(save) as delivery_log:
+        def record(user_id, status):
+            nonlocal first_send
+            if first_send:
+                # Отставание начала рассылки считается по первой фактической
+                # отправке, а не по переводу рассылки в 'sending'
+                first_send = False
+                run_in_background(database.record_first_send(message_id, time.time()))
+            metrics.DELIVERIES.labels(message_type, status).inc()
+            delivery_log.record(user_id, status)
+        
+        # Воркеры отправляют параллельно, а общий темп задают ограничители скорости
+        broadcaster = Broadcaster(
+            send,
+            workers=BROADCAST_WORKERS,
+            chat_interval=BROADCAST_CHAT_INTERVAL,
+            on_result=record,
+            bucket=rate_limiter,
+            stop=stop
+        )
+        sending = asyncio.create_task(broadcaster.run(recipients))
+        try:
+            while not sending.done():
+                await asyncio.wait({sending}, timeout=SHARD_LEASE_SECONDS / 3)
+                if sending.done():
+                    break
+                if not await database.renew_shard_lease(message_id, shard_no, WORKER_ID, SHARD_LEASE_SECONDS):
+                    logger.warning(f"Аренда шарда {shard_no} рассылки #{message_id} потеряна "
+                                   f"или рассылка остановлена")
+                    lease_lost = True
+                    sending.cancel()
+                    break
+        finally:
+            if not sending.done():
+                sending.cancel()
+        try:
+            await sending
+        except asyncio.CancelledError:
+            if not lease_lost:
+                raise
+    
+    if broadcaster.result.aborted:
+        # Воркеры других процессов остановятся при продлении аренды
+        await database.change_message_status(message_id, ('sending', 'paused'), 'source_deleted')
+        broadcast_stops.pop(message_id, None)
+        prepared_senders.pop(message_id, None)
+    
+    if lease_lost or broadcaster.result.stopped:
+        # Неотправленная часть шарда достанется воркеру после возобновления
+        await database.release_shard(message_id, shard_no, WORKER_ID)
+        return False
+    if await database.finish_shard(message_id, shard_no, WORKER_ID):
+        broadcast_stops.pop(message_id, None)
+        prepared_senders.pop(message_id, None)
+    return True
 
-# Вспомогательные функции
-def is_admin(user_id):
-    """Проверяет, является ли пользователь администратором"""
-    return user_id in ADMIN_IDS
+async def process_shards(message_id=None):
+    """Обрабатывает свободные шарды рассылок, пока они не закончатся
 
-async def send_message_to_subscribers(message_type, content, media_id=None, caption=None):
-    """Отправляет сообщение всем подписчикам"""
-    subscribers = get_all_subscribers()
-    sent_count = 0
-    failed_count = 0
-    
-    for user_id in subscribers:
+    Если задан message_id, берутся только шарды этой рассылки; у
+    приостановленной или отмененной рассылки свободных шардов нет.
+    """
+    while True:
+        shard = await database.claim_shard(WORKER_ID, SHARD_LEASE_SECONDS, message_id)
+        if shard is None:
+            return
         try:
-            if message_type == 'text':
-                await bot.send_message(user_id, content)
-            elif message_type == 'photo':
-                if media_id.startswith('file://'):
-                    # Если это локальный файл
-                    local_path = media_id.replace('file://', '')
-                    photo = FSInputFile(local_path)
-                    await bot.send_photo(user_id, photo, caption=caption)
-                else:
-                    # Если это file_id
-                    await bot.send_photo(user_id, media_id, caption=caption)
-            elif message_type == 'video':
-                if media_id.startswith('file://'):
-                    # Если это локальный файл
-                    local_path = media_id.replace('file://', '')
-                    video = FSInputFile(local_path)
-                    await bot.send_video(user_id, video, caption=caption)
-                else:
-                    # Если это file_id
-                    await bot.send_video(user_id, media_id, caption=caption)
-            
-            sent_count += 1
-            # Делаем небольшую паузу, чтобы не превысить ограничения API Telegram
-            await asyncio.sleep(0.05)
+            await process_shard(shard)
+        except Exception:
+            # Шард сразу возвращается в очередь, не дожидаясь конца аренды
+            try:
+                await database.release_shard(shard[0], shard[1], WORKER_ID)
+            except Exception as e:
+                logger.error(f"Не удалось освободить шард {shard[1]} рассылки #{shard[0]}: {e}")
+            raise
+
+async def run_shard_worker():
+    """Постоянно забирает шарды рассылок из базы и отправляет их"""
+    while True:
+        try:
+            await process_shards()
         except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-            failed_count += 1
+            logger.error(f"Ошибка при обработке шарда рассылки: {e}")
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+
+async def send_message_to_subscribers(message_id):
+    """Отправляет сообщение всем подписчикам, отмечая доставку каждому из них
+
+    Получатели делятся на шарды, которые могут обрабатывать и другие
+    процессы-воркеры. Возвращает (отправлено, ошибок) или None, если бот
+    работает диспетчером или отправка шарда прервалась ошибкой: тогда
+    рассылку доделают воркеры.
+    """
+    await database.start_deliveries(message_id)
+    await database.create_shards(message_id, SHARD_SIZE)
     
-    logger.info(f"Рассылка завершена: отправлено {sent_count}, ошибок {failed_count}")
-    return sent_count, failed_count
+    if BROADCAST_ROLE == 'dispatcher':
+        logger.info(f"Рассылка #{message_id} передана воркерам")
+        return None
+    
+    try:
+        await process_shards(message_id)
+    except Exception as e:
+        # Ошибка касается только шарда этого процесса: он уже возвращен
+        # в очередь, а остальные шарды воркеры продолжают отправлять
+        logger.error(f"Ошибка при отправке шарда рассылки #{message_id}: {e}")
+        return None
+    return await database.count_deliveries(message_id)
 
 async def scheduled_send(message_id):
     """Функция для выполнения запланированной отправки"""
     logger.info(f"Выполнение запланированной рассылки #{message_id}")
     
-    messages = get_scheduled_messages()
-    target_message = None
-    
-    for msg in messages:
-        if msg[0] == message_id:
-            target_message = msg
-            break
+    target_message = await database.get_scheduled_message(message_id)
     
     if not target_message:
         logger.error(f"Сообщение #{message_id} не найдено в запланированных")
         return
     
-    msg_id, msg_type, msg_content, media_id, caption, _ = target_message
+    await deliver_message(message_id)
+
+async def prewarm_broadcast(message_id):
+    """Готовит запланированную рассылку за PREWARM_SECONDS до начала
+
+    Фиксирует получателей и делит их на шарды, загружает локальный файл
+    (он отправляется автору рассылки), собирает функцию отправки и незадолго
+    до назначенного времени открывает соединения с Bot API для всех воркеров.
+    В назначенное время scheduled_send сразу начинает отправку.
+    """
+    target_message = await database.get_scheduled_message(message_id)
+    if not target_message:
+        return
+    (_, message_type, content, media_id, caption, scheduled_time,
+     source_chat_id, source_message_id, created_by) = target_message
     
     try:
-        sent, failed = await send_message_to_subscribers(msg_type, msg_content, media_id, caption)
-        update_message_status(message_id, 'sent')
-        logger.info(f"Запланированная рассылка #{message_id} выполнена: {sent} отправлено, {failed} ошибок")
+        recipients = await database.prepare_deliveries(message_id)
+        await database.create_shards(message_id, SHARD_SIZE)
+        
+        if message_type in ('photo', 'video') and media_id.startswith('file://') and created_by:
+            local_path = media_id.replace('file://', '')
+            if not await database.get_cached_file_id(local_path, os.path.getmtime(local_path), message_type):
+                await upload_media(message_type, local_path, created_by,
+                                   f"Файл рассылки #{message_id} загружен заранее")
+        
+        if BROADCAST_ROLE == 'dispatcher':
+            logger.info(f"Рассылка #{message_id} подготовлена, получателей: {recipients}")
+            return
+        
+        media_items = None
+        if message_type == 'media_group':
+            media_items = await database.get_media_group_items(message_id)
+        send = await build_sender(
+            message_type, content, media_id, caption, media_items,
+            (source_chat_id, source_message_id))
+        # Рассылка могла начаться, пока шла подготовка: тогда готовая функция
+        # отправки уже не пригодится и не должна остаться в памяти
+        if not await database.get_scheduled_message(message_id):
+            return
+        prepared_senders[message_id] = send
+        logger.info(f"Рассылка #{message_id} подготовлена, получателей: {recipients}")
+        run_in_background(open_connections(message_id, scheduled_time))
     except Exception as e:
-        update_message_status(message_id, 'failed')
-        logger.error(f"Ошибка при выполнении запланированной рассылки #{message_id}: {e}")
+        # Неподготовленная рассылка все равно начнется в назначенное время
+        logger.error(f"Ошибка при подготовке рассылки #{message_id}: {e}")
+
+async def open_connections(message_id, scheduled_time):
+    """Незадолго до начала рассылки открывает соединения с Bot API для всех воркеров"""
+    # Простаивающие соединения закрываются через HTTP_KEEPALIVE секунд,
+    # поэтому открываем их только перед самым началом
+    run_at = datetime.strptime(scheduled_time, "%Y-%m-%d %H:%M:%S")
+    delay = (run_at - datetime.now()).total_seconds() - 2
+    if delay > 0:
+        await asyncio.sleep(delay)
+    # HTTP_POOL_SIZE=0 - пул без ограничения размера
+    connections = min(BROADCAST_WORKERS, HTTP_POOL_SIZE) if HTTP_POOL_SIZE else BROADCAST_WORKERS
+    opened = await bot.session.warm_up(bot, connections)
+    logger.info(f"Для рассылки #{message_id} открыто соединений с Bot API: {opened}")
+
+def schedule_broadcast(message_id, run_date):
+    """Планирует рассылку и ее подготовку за PREWARM_SECONDS до начала
+
+    Рассылку, до которой осталось меньше PREWARM_SECONDS (или уже
+    просроченную), не готовим: подготовка совпала бы с отправкой.
+    """
+    scheduler.add_job(
+        scheduled_send,
+        trigger=DateTrigger(run_date=run_date),
+        args=[message_id],
+        id=f"msg_{message_id}",
+        replace_existing=True
+    )
+    prewarm_at = run_date - timedelta(seconds=PREWARM_SECONDS)
+    if PREWARM_SECONDS > 0 and prewarm_at > datetime.now():
+        scheduler.add_job(
+            prewarm_broadcast,
+            trigger=DateTrigger(run_date=prewarm_at),
+            args=[message_id],
+            id=f"prewarm_{message_id}",
+            replace_existing=True
+        )
+
+async def deliver_message(message_id):
+    """Выполняет рассылку и сохраняет ее итоговый статус"""
+    try:
+        result = await send_message_to_subscribers(message_id)
+        if result is not None:
+            sent, failed = result
+            logger.info(f"Рассылка #{message_id}: {sent} отправлено, {failed} ошибок")
+    except Exception as e:
+        await database.update_message_status(message_id, 'failed')
+        logger.error(f"Ошибка при выполнении рассылки #{message_id}: {e}")
+
+def progress_keyboard(message_id, status):
+    """Кнопки управления рассылкой в сообщении о ее ходе"""
+    kb = InlineKeyboardBuilder()
+    if status == 'paused':
+        kb.button(text="▶️ Продолжить", callback_data=f"broadcast_resume:{message_id}")
+    else:
+        kb.button(text="⏸ Пауза", callback_data=f"broadcast_pause:{message_id}")
+    kb.button(text="⏹ Отменить", callback_data=f"broadcast_cancel:{message_id}")
+    kb.adjust(2)
+    return kb.as_markup()
+
+def format_progress(message_id, status, pending, sent, failed, rate):
+    """Текст сообщения о ходе рассылки"""
+    text = f"{hbold(PROGRESS_TITLES.get(status, status))}\n\n"
+    text += f"ID рассылки: {message_id}\n"
+    text += f"Отправлено: {sent} из {pending + sent + failed}\n"
+    text += f"Ошибок: {failed}\n"
+    if status == 'sending' and rate > 0:
+        text += f"Скорость: {rate:.1f} сообщ./с\n"
+        text += f"Осталось: ~{timedelta(seconds=round(pending / rate))}\n"
+    return text
+
+async def report_progress(message_id, chat_id):
+    """Показывает ход рассылки в одном сообщении с кнопками управления
+
+    Сообщение обновляется не чаще раза в PROGRESS_INTERVAL секунд, пока
+    рассылка не завершится. Данные берутся из базы, поэтому учитываются
+    сообщения, отправленные всеми процессами-воркерами.
+    """
+    progress_message = None
+    last_text = None
+    last_done = last_time = None
+    rate = 0.0
+    errors = 0
+    while True:
+        try:
+            progress = await database.get_delivery_progress(message_id)
+            if progress is None:
+                return
+            status, pending, sent, failed = progress
+            
+            # Скорость - за последний интервал, чтобы оценка времени учитывала
+            # паузы и флуд-контроль
+            now = time.monotonic()
+            if last_time is not None and status == 'sending':
+                rate = (sent + failed - last_done) / (now - last_time)
+            last_done, last_time = sent + failed, now
+            
+            finished = status not in ('pending', 'sending', 'paused')
+            text = format_progress(message_id, status, pending, sent, failed, rate)
+            reply_markup = None if finished else progress_keyboard(message_id, status)
+            if text != last_text:
+                try:
+                    if progress_message is None:
+                        progress_message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                    else:
+                        await progress_message.edit_text(text, reply_markup=reply_markup)
+                    last_text = text
+                except TelegramBadRequest as e:
+                    logger.warning(f"Не удалось обновить ход рассылки #{message_id}: {e}")
+            errors = 0
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: ждем и повторяем, итоговое состояние не теряется
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            # Сбой сети или базы: пробуем снова через интервал
+            errors += 1
+            logger.error(f"Ошибка при обновлении хода рассылки #{message_id}: {e}")
+            if errors >= PROGRESS_MAX_ERRORS:
+                return
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            continue
+        
+        if finished:
+            return
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+def start_broadcast(message_id, chat_id):
+    """Запускает рассылку в фоне и показывает ее ход в чате chat_id"""
+    run_in_background(deliver_message(message_id))
+    run_in_background(report_progress(message_id, chat_id))
 
 # Обработчики команд
 @router.message(CommandStart())
@@ -285,7 +766,9 @@ async def cmd_start(message: Message):
     if is_admin(user_id):
         welcome_text += f"\n\n{hbold('Вы являетесь администратором!')} Дополнительные команды:\n"
         welcome_text += "/send_message - отправить сообщение всем подписчикам\n"
-        welcome_text += "/stats - статистика по подписчикам"
+        welcome_text += "/stats - статистика по подписчикам\n"
+        welcome_text += "/progress ID - ход рассылки и управление ею\n"
+        welcome_text += "/tag ТЕГ ID... и /untag ТЕГ ID... - теги подписчиков для сегментов"
     
     await message.answer(welcome_text)
 
@@ -297,11 +780,11 @@ async def cmd_subscribe(message: Message):
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
     
-    if is_subscribed(user_id):
+    if await database.is_subscribed(user_id):
         await message.answer("Вы уже подписаны на рассылку! 😊")
         return
     
-    add_subscriber(user_id, username, first_name, last_name)
+    await database.add_subscriber(user_id, username, first_name, last_name, message.from_user.language_code)
     await message.answer("Вы успешно подписались на рассылку! 🎉\nТеперь вы будете получать важные сообщения.")
 
 @router.message(Command("unsubscribe"))
@@ -309,11 +792,11 @@ async def cmd_unsubscribe(message: Message):
     """Обработчик команды /unsubscribe"""
     user_id = message.from_user.id
     
-    if not is_subscribed(user_id):
+    if not await database.is_subscribed(user_id):
         await message.answer("Вы не были подписаны на рассылку. 🤔")
         return
     
-    remove_subscriber(user_id)
+    await database.remove_subscriber(user_id)
     await message.answer("Вы успешно отписались от рассылки. 👋\nНадеемся увидеть вас снова!")
 
 @router.message(Command("status"))
@@ -321,7 +804,7 @@ async def cmd_status(message: Message):
     """Обработчик команды /status"""
     user_id = message.from_user.id
     
-    if is_subscribed(user_id):
+    if await database.is_subscribed(user_id):
         await message.answer("Вы подписаны на рассылку! 👍")
     else:
         await message.answer("Вы не подписаны на рассылку. Используйте /subscribe чтобы подписаться.")
@@ -351,17 +834,59 @@ async def process_send_mode(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
     send_mode = callback.data
-    await state.update_data(send_mode=send_mode)
+    await state.update_data(send_mode=send_mode, segment=None, segment_count=None)
     
-    if send_mode == 'send_now':
-        await callback.message.answer(
+    kb = InlineKeyboardBuilder()
+    kb.button(text="Всем подписчикам", callback_data="audience_all")
+    kb.button(text="Выбрать сегмент", callback_data="audience_segment")
+    kb.adjust(2)
+    
+    await callback.message.answer("Кому отправить рассылку?", reply_markup=kb.as_markup())
+    await state.set_state(SendMessageStates.choosing_audience)
+
+@router.callback_query(F.data.in_(["audience_all", "audience_segment"]), SendMessageStates.choosing_audience)
+async def process_audience(callback: CallbackQuery, state: FSMContext):
+    """Обработчик выбора получателей рассылки"""
+    await callback.answer()
+    
+    if callback.data == 'audience_segment':
+        await callback.message.answer(SEGMENT_HELP)
+        await state.set_state(SendMessageStates.waiting_for_segment)
+        return
+    
+    await ask_for_message(callback.message, state)
+
+@router.message(SendMessageStates.waiting_for_segment)
+async def process_segment(message: Message, state: FSMContext):
+    """Обработчик условий сегмента рассылки"""
+    try:
+        segment = parse_segment(message.text or "")
+    except ValueError:
+        await message.answer(f"Не удалось разобрать условия.\n\n{SEGMENT_HELP}")
+        return
+    
+    # Число получателей считается один раз (по индексам) и дальше берется из диалога
+    segment_count = await database.count_segment(segment)
+    if not segment_count:
+        await message.answer("В этом сегменте нет подписчиков. Укажите другие условия.")
+        return
+    
+    await state.update_data(segment=segment, segment_count=segment_count)
+    await message.answer(f"Сегмент: {describe_segment(segment)}\nПодписчиков в сегменте: {segment_count}")
+    await ask_for_message(message, state)
+
+async def ask_for_message(message: Message, state: FSMContext):
+    """Просит прислать сообщение для рассылки"""
+    user_data = await state.get_data()
+    if user_data.get('send_mode') == 'send_now':
+        await message.answer(
             "Отправьте сообщение, которое нужно разослать подписчикам.\n\n"
-            "Вы можете отправить текст, фото или видео.",
+            "Вы можете отправить любое сообщение: текст, фото, видео, документ, опрос или альбом.",
         )
     else:  # schedule
-        await callback.message.answer(
+        await message.answer(
             "Отправьте сообщение, которое нужно запланировать для рассылки.\n\n"
-            "Вы можете отправить текст, фото или видео.",
+            "Вы можете отправить любое сообщение: текст, фото, видео, документ, опрос или альбом.",
         )
     
     await state.set_state(SendMessageStates.waiting_for_message)
@@ -372,34 +897,64 @@ async def process_message_for_sending(message: Message, state: FSMContext):
     user_data = await state.get_data()
     send_mode = user_data.get('send_mode')
     
-    if message.text and not message.media_group_id:
-        # Обработка текстового сообщения
+    if message.media_group_id and (message.photo or message.video):
+        # Часть альбома: части копятся в данных FSM, а дальше диалог
+        # продолжается, когда придет последняя из них
+        if user_data.get('media_group_id') == message.media_group_id:
+            items = user_data.get('media_group_items', [])
+        else:
+            items = []
+        items.append({
+            'message_id': message.message_id,
+            'type': 'photo' if message.photo else 'video',
+            'file_id': message.photo[-1].file_id if message.photo else message.video.file_id,
+            'caption': message.caption or "",
+            'caption_entities': [
+                entity.model_dump(mode='json', exclude_none=True)
+                for entity in message.caption_entities or []
+            ],
+        })
+        items.sort(key=lambda item: item['message_id'])
         await state.update_data(
-            message_type='text',
-            message_content=message.text,
-            media_id=None,
-            caption=None
-        )
-    elif message.photo:
-        # Обработка фотографии
-        await state.update_data(
-            message_type='photo',
+            message_type='media_group',
             message_content=None,
-            media_id=message.photo[-1].file_id,  # Берём последнее (самое качественное) фото
-            caption=message.caption or ""
+            media_id=None,
+            caption=None,
+            media_group_id=message.media_group_id,
+            media_group_items=items
         )
-    elif message.video:
-        # Обработка видео
+        run_in_background(finish_media_group(message, state, message.media_group_id, len(items)))
+        return
+    elif message.media_group_id:
+        await message.answer("Альбомы можно рассылать только из фото и видео.")
+        return
+    else:
+        # Любое другое сообщение (текст с форматированием, фото, видео,
+        # документ, опрос...) рассылается копированием из этого чата
         await state.update_data(
-            message_type='video',
+            message_type='copy',
             message_content=None,
-            media_id=message.video.file_id,
-            caption=message.caption or ""
+            media_id=None,
+            caption=None,
+            source_chat_id=message.chat.id,
+            source_message_id=message.message_id
         )
-    else:
-        await message.answer("Пожалуйста, отправьте текст, фото или видео для рассылки.")
-        return
     
+    await ask_next_step(message, state, send_mode)
+
+async def finish_media_group(message: Message, state: FSMContext, media_group_id, count):
+    """Продолжает диалог, если за MEDIA_GROUP_WAIT секунд не пришло новых частей альбома"""
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    if await state.get_state() != SendMessageStates.waiting_for_message.state:
+        return
+    user_data = await state.get_data()
+    if (user_data.get('media_group_id') != media_group_id
+            or len(user_data.get('media_group_items', [])) != count):
+        return
+    await ask_next_step(message, state, user_data.get('send_mode'))
+
+async def ask_next_step(message: Message, state: FSMContext, send_mode):
+    """Переходит к подтверждению или к выбору времени рассылки"""
     if send_mode == 'send_now':
         await send_confirmation(message, state)
     else:  # schedule
@@ -414,10 +969,13 @@ async def send_confirmation(message: Message, state: FSMContext):
     """Отправляет сообщение с подтверждением рассылки"""
     user_data = await state.get_data()
     
-    subscribers_count = count_subscribers()
+    subscribers_count = await count_recipients(user_data)
     
     confirmation_text = f"📬 {hbold('Подтверждение рассылки')}\n\n"
+    confirmation_text += f"Получатели: {describe_segment(user_data.get('segment'))}\n"
     confirmation_text += f"Сообщение будет отправлено {hbold(str(subscribers_count))} подписчикам.\n\n"
+    if user_data.get('message_type') == 'media_group':
+        confirmation_text += f"Альбом: {len(user_data.get('media_group_items', []))} файлов\n\n"
     
     kb = InlineKeyboardBuilder()
     kb.button(text="✅ Подтвердить", callback_data="confirm_send")
@@ -440,7 +998,8 @@ async def process_schedule_time(message: Message, state: FSMContext):
                                "Пожалуйста, укажите будущую дату и время.")
             return
         
-        await state.update_data(schedule_time=schedule_time)
+        # Данные FSM хранятся в JSON, поэтому время сохраняется строкой
+        await state.update_data(schedule_time=schedule_time.strftime("%Y-%m-%d %H:%M:%S"))
         
         # Формируем сообщение с информацией о планировании
         user_data = await state.get_data()
@@ -448,7 +1007,8 @@ async def process_schedule_time(message: Message, state: FSMContext):
         scheduled_text = f"📅 {hbold('Планирование рассылки')}\n\n"
         scheduled_text += f"Тип сообщения: {message_type}\n"
         scheduled_text += f"Запланировано на: {schedule_time.strftime('%d.%m.%Y %H:%M')}\n"
-        scheduled_text += f"Получатели: {count_subscribers()} подписчиков\n\n"
+        scheduled_text += f"Получатели: {describe_segment(user_data.get('segment'))}, "
+        scheduled_text += f"{await count_recipients(user_data)} подписчиков\n\n"
         
         kb = InlineKeyboardBuilder()
         kb.button(text="✅ Подтвердить", callback_data="confirm_schedule")
@@ -479,50 +1039,115 @@ async def process_sending_confirmation(callback: CallbackQuery, state: FSMContex
     media_id = user_data.get('media_id')
     caption = user_data.get('caption')
     send_mode = user_data.get('send_mode')
+    media_items = [
+        (item['type'], item['file_id'], item['caption'], item.get('caption_entities'))
+        for item in user_data.get('media_group_items', [])
+    ] if message_type == 'media_group' else None
+    source = (
+        user_data.get('source_chat_id'), user_data.get('source_message_id')
+    ) if message_type == 'copy' else None
     
     if callback.data == 'confirm_send':
         # Отправляем сразу
-        await callback.message.answer("Начинаю рассылку...")
-        
-        sent, failed = await send_message_to_subscribers(message_type, message_content, media_id, caption)
-        
-        await callback.message.answer(
-            f"✅ {hbold('Рассылка завершена!')}\n\n"
-            f"Отправлено: {sent}\n"
-            f"Ошибок: {failed}"
+        # Немедленная рассылка тоже сохраняется в базе, чтобы ее можно было
+        # продолжить после перезапуска бота
+        message_id = await database.add_scheduled_message(
+            message_type,
+            message_content,
+            media_id,
+            caption,
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            callback.from_user.id,
+            media_items,
+            source,
+            user_data.get('segment')
         )
+        
+        # Рассылка идет в фоне, не задерживая обработку других обновлений
+        start_broadcast(message_id, callback.message.chat.id)
     
     elif callback.data == 'confirm_schedule':
         # Планируем отправку
-        schedule_time = user_data.get('schedule_time')
+        schedule_time = datetime.strptime(user_data.get('schedule_time'), "%Y-%m-%d %H:%M:%S")
         
         # Добавляем в базу данных
-        message_id = add_scheduled_message(
+        message_id = await database.add_scheduled_message(
             message_type, 
             message_content, 
             media_id, 
             caption, 
             schedule_time.strftime("%Y-%m-%d %H:%M:%S"),
-            callback.from_user.id
+            callback.from_user.id,
+            media_items,
+            source,
+            user_data.get('segment')
         )
         
         # Планируем задачу
-        scheduler.add_job(
-            scheduled_send,
-            trigger=DateTrigger(run_date=schedule_time),
-            args=[message_id],
-            id=f"msg_{message_id}"
-        )
+        schedule_broadcast(message_id, schedule_time)
         
         await callback.message.answer(
             f"✅ {hbold('Рассылка запланирована!')}\n\n"
             f"ID рассылки: {message_id}\n"
             f"Время отправки: {schedule_time.strftime('%d.%m.%Y %H:%M')}\n"
-            f"Получатели: {count_subscribers()} подписчиков"
+            f"Получатели: {describe_segment(user_data.get('segment'))}, "
+            f"{await count_recipients(user_data)} подписчиков"
         )
     
     await state.clear()
 
+@router.callback_query(F.data.startswith("broadcast_"))
+async def process_broadcast_control(callback: CallbackQuery):
+    """Обработчик кнопок паузы, продолжения и отмены рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Управлять рассылками могут только администраторы.", show_alert=True)
+        return
+    
+    action, message_id = callback.data[len("broadcast_"):].split(":")
+    message_id = int(message_id)
+    current_statuses, status, notice = BROADCAST_ACTIONS[action]
+    
+    if not await database.change_message_status(message_id, current_statuses, status):
+        await callback.answer("Рассылка уже завершена или ее состояние изменилось.", show_alert=True)
+        return
+    
+    # Воркеры этого процесса останавливаются сразу, другие процессы -
+    # при очередном продлении аренды шарда
+    if status != 'sending':
+        stop = broadcast_stops.pop(message_id, None)
+        if stop is not None:
+            stop.set()
+        if status == 'cancelled':
+            prepared_senders.pop(message_id, None)
+    else:
+        # Шарды могли закончиться или еще не быть созданы к моменту паузы
+        await database.create_shards(message_id, SHARD_SIZE)
+    
+    await callback.answer(notice)
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=None if status == 'cancelled' else progress_keyboard(message_id, status)
+        )
+    except TelegramBadRequest:
+        pass
+
+@router.message(Command("progress"))
+async def cmd_progress(message: Message, command: CommandObject):
+    """Обработчик команды /progress: ход рассылки с кнопками управления"""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администраторам.")
+        return
+    
+    if not command.args or not command.args.strip().isdigit():
+        await message.answer("Укажите ID рассылки, например: /progress 15")
+        return
+    
+    message_id = int(command.args)
+    if await database.get_delivery_progress(message_id) is None:
+        await message.answer(f"Рассылка #{message_id} не найдена.")
+        return
+    run_in_background(report_progress(message_id, message.chat.id))
+
 @router.message(Command("stats"))
 async def cmd_stats(message: Message):
     """Обработчик команды /stats"""
@@ -532,49 +1157,121 @@ async def cmd_stats(message: Message):
         await message.answer("Эта команда доступна только администраторам.")
         return
     
-    subscribers_count = count_subscribers()
+    subscribers_count = await database.count_subscribers()
     
     stats_text = f"📊 {hbold('Статистика бота')}\n\n"
     stats_text += f"Всего подписчиков: {subscribers_count}\n"
     
+    # Пользователи, заблокировавшие бота, исключаются из рассылок
+    inactive_count, reclaimed_sends = await database.get_inactive_report()
+    if inactive_count:
+        inactive_share = inactive_count * 100 / (subscribers_count + inactive_count)
+        stats_text += f"Недоступны (заблокировали бота): {inactive_count} ({inactive_share:.1f}%)\n"
+        stats_text += f"Сэкономлено отправок: {reclaimed_sends}"
+        stats_text += f" (~{reclaimed_sends / BROADCAST_RATE:.0f} с рассылки)\n"
+    
     # Получаем запланированные сообщения
-    scheduled = get_scheduled_messages()
-    stats_text += f"\nЗапланированные рассылки: {len(scheduled)}\n"
+    scheduled_count = await database.count_scheduled_messages()
+    stats_text += f"\nЗапланированные рассылки: {scheduled_count}\n"
     
-    if scheduled:
+    if scheduled_count:
         stats_text += f"\n📅 {hbold('Ближайшие рассылки:')}\n"
-        for i, msg in enumerate(scheduled[:5]):  # Показываем только 5 ближайших
+        # Показываем только 5 ближайших
+        for i, msg in enumerate(await database.get_scheduled_messages(limit=5)):
             msg_id, msg_type, _, _, _, scheduled_time = msg
             scheduled_dt = datetime.strptime(scheduled_time, "%Y-%m-%d %H:%M:%S")
             stats_text += f"{i+1}. ID: {msg_id}, Тип: {msg_type}, Время: {scheduled_dt.strftime('%d.%m.%Y %H:%M')}\n"
     
+    # Теги, по которым можно выбрать сегмент рассылки
+    tag_counts = await database.get_tag_counts()
+    if tag_counts:
+        stats_text += f"\n🏷 {hbold('Теги:')} "
+        stats_text += ", ".join(f"{tag} ({count})" for tag, count in tag_counts)
+        stats_text += "\n"
+    
     await message.answer(stats_text)
 
+@router.message(Command("tag", "untag"))
+async def cmd_tag(message: Message, command: CommandObject):
+    """Обработчик команд /tag и /untag: назначение и снятие тегов подписчиков"""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администраторам.")
+        return
+    
+    args = (command.args or "").split()
+    if len(args) < 2 or not all(arg.lstrip('-').isdigit() for arg in args[1:]):
+        await message.answer(f"Использование: /{command.command} ТЕГ ID [ID ...]\n"
+                             f"Например: /{command.command} vip 123456789 987654321")
+        return
+    
+    tag = normalize_tag(args[0])
+    if not tag:
+        await message.answer("Тег не может быть пустым.")
+        return
+    user_ids = [int(arg) for arg in args[1:]]
+    if command.command == 'tag':
+        await database.add_subscriber_tag(tag, user_ids)
+        await message.answer(f"Тег {hbold(tag)} назначен пользователям: {len(user_ids)}")
+    else:
+        await database.remove_subscriber_tag(tag, user_ids)
+        await message.answer(f"Тег {hbold(tag)} снят с пользователей: {len(user_ids)}")
+
 # Запуск бота
+def on_job_missed(event):
+    """Отмечает рассылку, которую планировщик пропустил, как 'missed'"""
+    if event.job_id.startswith('msg_'):
+        message_id = int(event.job_id[len('msg_'):])
+        logger.warning(f"Рассылка #{message_id} пропущена: бот не работал в назначенное время")
+        run_in_background(database.update_message_status(message_id, 'missed'))
+
 async def on_startup():
     """Действия при запуске бота"""
-    init_db()
+    await database.init_db()
+    
+    # Загружаем подписчиков в память и периодически сверяем кэш с базой
+    await database.subscriber_cache.load()
+    database.subscriber_writer.start()
+    scheduler.add_job(
+        database.subscriber_cache.verify,
+        trigger=IntervalTrigger(minutes=SUBSCRIBER_CACHE_CHECK_MINUTES),
+        id="subscriber_cache_check"
+    )
     
-    # Восстанавливаем запланированные задачи из базы данных
-    scheduled_messages = get_scheduled_messages()
-    for msg in scheduled_messages:
+    # Состояния диалогов пишутся в базу пачками, истекшие удаляются раз в час
+    storage.start()
+    scheduler.add_job(
+        storage.delete_expired,
+        trigger=IntervalTrigger(hours=1),
+        id="fsm_states_cleanup"
+    )
+    
+    # Рассылки, время которых прошло больше допустимого, уже не отправляем
+    deadline = datetime.now() - timedelta(seconds=SCHEDULE_MISFIRE_GRACE_SECONDS)
+    await database.expire_missed_messages(deadline.strftime("%Y-%m-%d %H:%M:%S"))
+    
+    # Запускаем планировщик на паузе, чтобы сначала восстановить задачи
+    scheduler.add_listener(on_job_missed, EVENT_JOB_MISSED)
+    scheduler.start(paused=True)
+    
+    # Задачи запланированных рассылок восстанавливаем из базы
+    for msg in await database.get_scheduled_messages():
         msg_id, _, _, _, _, scheduled_time = msg
-        scheduled_dt = datetime.strptime(scheduled_time, "%Y-%m-%d %H:%M:%S")
-        
-        # Если время еще не наступило
-        if scheduled_dt > datetime.now():
-            scheduler.add_job(
-                scheduled_send,
-                trigger=DateTrigger(run_date=scheduled_dt),
-                args=[msg_id],
-                id=f"msg_{msg_id}"
-            )
-            logger.info(f"Восстановлена запланированная рассылка #{msg_id} на {scheduled_time}")
+        schedule_broadcast(msg_id, datetime.strptime(scheduled_time, "%Y-%m-%d %H:%M:%S"))
+        logger.info(f"Восстановлена запланированная рассылка #{msg_id} на {scheduled_time}")
     
-    # Запускаем планировщик
-    scheduler.start()
+    # Пропущенные в пределах допустимого времени рассылки выполнятся сразу
+    scheduler.resume()
     logger.info("Планировщик запущен")
     
+    # Прерванные остановкой рассылки продолжат воркеры: шарды, аренда
+    # которых истекла, снова становятся свободными
+    for msg in await database.get_scheduled_messages('sending'):
+        logger.info(f"Возобновление прерванной рассылки #{msg[0]}")
+        await database.create_shards(msg[0], SHARD_SIZE)
+    
+    if BROADCAST_ROLE == 'local':
+        run_in_background(run_shard_worker())
+    
     # Логируем информацию о запуске бота
     logger.info("Бот запущен и готов к работе!")
 
@@ -584,16 +1281,103 @@ async def on_shutdown():
     scheduler.shutdown()
     logger.info("Планировщик остановлен")
     
-    # Закрываем соединения
+    # Останавливаем фоновые задачи; недоставленные сообщения останутся
+    # в очереди доставок
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    
+    # Записываем накопленные подписки и состояния диалогов и закрываем соединения
+    await database.subscriber_writer.stop()
+    await storage.close()
+    await database.db.close()
     logger.info("Бот остановлен")
 
+async def wait_for_stop_signal():
+    """Ждет сигнала остановки процесса (SIGINT или SIGTERM)"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # На Windows обработчики сигналов в цикле событий недоступны
+            pass
+    await stop_event.wait()
+
+async def run_worker():
+    """Режим воркера: только отправка шардов рассылок, без приема обновлений"""
+    await database.init_db()
+    logger.info(f"Воркер рассылок {WORKER_ID} запущен")
+    worker = asyncio.create_task(run_shard_worker())
+    try:
+        await wait_for_stop_signal()
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await bot.session.close()
+        await database.db.close()
+        logger.info(f"Воркер рассылок {WORKER_ID} остановлен")
+
+async def run_webhook():
+    """Принимает обновления через вебхук на aiohttp-сервере"""
+    app = web.Application()
+    # Запросы без верного заголовка X-Telegram-Bot-Api-Secret-Token отклоняются
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук-сервер запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("Вебхук зарегистрирован в Telegram")
+    else:
+        logger.warning("WEBHOOK_URL не задан: вебхук в Telegram не зарегистрирован")
+    
+    try:
+        await wait_for_stop_signal()
+    finally:
+        # Сначала перестаем принимать новые обновления, затем дожидаемся
+        # обработки уже принятых
+        await runner.cleanup()
+        await concurrency_limiter.drain(SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+
 async def main():
-    # Запускаем процесс поллинга новых апдейтов
-    await on_startup()
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == 'worker':
+            await run_worker()
+            return
+        
+        await on_startup()
+        try:
+            if BOT_MODE == 'webhook':
+                await run_webhook()
+            else:
+                # Запускаем процесс поллинга новых апдейтов
+                await dp.start_polling(bot)
+        finally:
+            await on_shutdown()
     finally:
-        await on_shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""Метрики Prometheus: рассылки, база данных и обработчики обновлений
+
+Метрики отдаются на локальном HTTP-сервере по адресу /metrics.
+"""
+import functools
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Отправка одного сообщения занимает от десятков миллисекунд до нескольких
+# секунд (загрузка файла); запросы к базе - от долей миллисекунды
+SEND_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+SEND_SECONDS = Histogram(
+    'bot_send_seconds', 'Длительность отправки сообщения одному получателю',
+    ['message_type'], buckets=SEND_BUCKETS)
+DELIVERIES = Counter(
+    'bot_deliveries_total', 'Результаты доставки рассылок получателям',
+    ['message_type', 'status'])
+FLOOD_WAITS = Counter(
+    'bot_flood_waits_total', 'Ответы Telegram 429 (флуд-контроль)')
+FLOOD_WAIT_SECONDS = Counter(
+    'bot_flood_wait_seconds_total', 'Сумма retry_after из ответов 429')
+QUEUE_DEPTH = Gauge(
+    'bot_broadcast_queue_depth', 'Получатели в очереди рассылки, ожидающие воркера')
+WORKERS_IN_FLIGHT = Gauge(
+    'bot_broadcast_workers_in_flight', 'Воркеры рассылки, занятые отправкой')
+DB_CALL_SECONDS = Histogram(
+    'bot_db_call_seconds', 'Длительность вызовов функций базы данных',
+    ['call'], buckets=DB_BUCKETS)
+BROADCAST_START_LAG = Histogram(
+    'bot_broadcast_start_lag_seconds', 'Отставание начала рассылки от назначенного времени',
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+THROTTLED_UPDATES = Counter(
+    'bot_throttled_updates_total', 'Обновления, отброшенные ограничением частоты',
+    ['command', 'reason'])
+HTTP_CONNECTIONS = Gauge(
+    'bot_http_connections', 'Соединения с Bot API в пуле HTTP-сессии (in_use - занятые запросами)',
+    ['state'])
+HTTP_POOL_LIMIT = Gauge(
+    'bot_http_pool_limit', 'Размер пула соединений с Bot API')
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds', 'Длительность обработчиков обновлений',
+    ['handler'])
+
+
+def timed_db_call(func):
+    """Декоратор: длительность каждого вызова корутины попадает в DB_CALL_SECONDS"""
+    histogram = DB_CALL_SECONDS.labels(func.__qualname__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with histogram.time():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Запускает HTTP-сервер метрик в текущем цикле событий"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,208 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from metrics import HANDLER_SECONDS, THROTTLED_UPDATES
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых обновлений"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def drain(self, timeout: float):
+        """Ждет завершения уже принятых обновлений, но не дольше timeout секунд"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self._in_flight} обновлений")
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Измеряет длительность каждого обработчика роутера
+
+    Регистрируется как внутренняя middleware: к этому моменту aiogram уже
+    выбрал обработчик, и его имя становится меткой метрики.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        with HANDLER_SECONDS.labels(name).time():
+            return await handler(event, data)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Сообщает о каждом обновлении от пользователя (для сегмента по активности)"""
+
+    def __init__(self, on_activity: Callable[[int, Optional[str]], None]):
+        self.on_activity = on_activity
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is not None and not user.is_bot:
+            self.on_activity(user.id, user.language_code)
+        return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает обновления от пользователей, присылающих их слишком часто
+
+    Регистрируется первой внешней middleware диспетчера, чтобы отброшенные
+    обновления не занимали место в ConcurrencyLimitMiddleware и не доходили
+    до базы. Действуют три правила:
+    - одинаковые сообщения или нажатия кнопки одного пользователя чаще раза
+      в duplicate_interval секунд обрабатываются один раз;
+    - не больше user_limit обновлений от пользователя за window секунд;
+    - не больше global_limit обновлений от всех пользователей за window секунд
+      (0 - без ограничения).
+    Окно скользящее: счетчик предыдущего окна учитывается с весом, который
+    убывает по мере того, как оно уходит в прошлое. На пользователя хранится
+    три числа; записи, не обновлявшиеся два окна, удаляются.
+    Пользователи из exempt (администраторы) не ограничиваются: части
+    альбома приходят почти одновременно. На отброшенное нажатие кнопки
+    бот все равно отвечает, иначе у пользователя крутится индикатор загрузки.
+    """
+
+    def __init__(self, window: float = 10.0, user_limit: int = 20, global_limit: int = 0,
+                 duplicate_interval: float = 2.0, exempt: Iterable[int] = (),
+                 commands: Iterable[str] = ()):
+        self.window = window
+        self.user_limit = user_limit
+        self.global_limit = global_limit
+        self.duplicate_interval = duplicate_interval
+        self.exempt = set(exempt)
+        # Имена команд для меток метрики; остальные команды попадают в 'other'
+        self.commands = set(commands)
+        # [номер окна, счетчик предыдущего окна, счетчик текущего окна]
+        self._users: Dict[int, List[int]] = {}
+        self._global = [0, 0, 0]
+        # (пользователь, текст или данные кнопки) -> время последней обработки
+        self._recent: Dict[Tuple[int, str], float] = {}
+        self._next_cleanup = 0.0
+
+    def _allow(self, counter: List[int], now: float, limit: int) -> bool:
+        """Учитывает обновление в счетчике, если лимит еще не исчерпан"""
+        window = int(now // self.window)
+        if counter[0] != window:
+            counter[1] = counter[2] if counter[0] == window - 1 else 0
+            counter[2] = 0
+            counter[0] = window
+        elapsed = now / self.window - window
+        if counter[1] * (1 - elapsed) + counter[2] >= limit:
+            return False
+        counter[2] += 1
+        return True
+
+    def _cleanup(self, now: float):
+        """Удаляет записи, которые уже не влияют на лимиты"""
+        window = int(now // self.window)
+        self._users = {user_id: counter for user_id, counter in self._users.items()
+                       if counter[0] >= window - 1}
+        self._recent = {key: seen for key, seen in self._recent.items()
+                        if now - seen < self.duplicate_interval}
+        self._next_cleanup = now + self.window
+
+    def _describe(self, event: TelegramObject) -> Tuple[str, Optional[str]]:
+        """Метка для метрики и текст, по которому ищутся повторы"""
+        if isinstance(event, Update):
+            event = event.event
+        if isinstance(event, CallbackQuery):
+            return 'callback', event.data
+        if isinstance(event, Message):
+            text = event.text
+            if text and text.startswith('/'):
+                command = text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+                return command if command in self.commands else 'other', text
+            return 'message', text
+        return 'other', None
+
+    async def _answer_dropped(self, event: TelegramObject, data: Dict[str, Any], reason: str):
+        """Отвечает на отброшенное нажатие кнопки"""
+        if isinstance(event, Update):
+            event = event.event
+        bot = data.get('bot')
+        if not isinstance(event, CallbackQuery) or bot is None:
+            return
+        # Повтор не объясняем: первое нажатие уже обрабатывается
+        text = None if reason == 'duplicate' else "Слишком много запросов, попробуйте позже"
+        try:
+            await bot.answer_callback_query(event.id, text=text)
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось ответить на отброшенное нажатие кнопки: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now >= self._next_cleanup:
+            self._cleanup(now)
+        label, text = self._describe(event)
+
+        key = (user.id, text) if text is not None and self.duplicate_interval else None
+        counter = self._users.setdefault(user.id, [0, 0, 0])
+        if key is not None and now - self._recent.get(key, -self.duplicate_interval) < self.duplicate_interval:
+            reason = 'duplicate'
+        elif not self._allow(counter, now, self.user_limit):
+            reason = 'user'
+        elif self.global_limit and not self._allow(self._global, now, self.global_limit):
+            reason = 'global'
+        else:
+            reason = None
+        if reason is not None:
+            THROTTLED_UPDATES.labels(label, reason).inc()
+            await self._answer_dropped(event, data, reason)
+            return None
+
+        if key is not None:
+            self._recent[key] = now
+        return await handler(event, data)
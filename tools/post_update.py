@@ -0,0 +1,61 @@
+"""Отправляет поддельные обновления Telegram на локальный вебхук
+
+Пример:
+    python tools/post_update.py --secret MY_SECRET --text /status --count 100
+"""
+import time
+import asyncio
+import argparse
+import itertools
+
+from aiohttp import ClientSession
+
+update_ids = itertools.count(1)
+
+
+def make_update(user_id, text):
+    """Собирает обновление с текстовым сообщением от пользователя"""
+    return {
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Test"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if text.startswith('/') else [],
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', required=True, help='значение WEBHOOK_SECRET бота')
+    parser.add_argument('--text', default='/status')
+    parser.add_argument('--user-id', type=int, default=1, help='ID первого пользователя')
+    parser.add_argument('--count', type=int, default=1, help='сколько обновлений отправить')
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    statuses = {}
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret}
+
+    async with ClientSession() as session:
+        async def post(user_id):
+            async with semaphore:
+                async with session.post(args.url, json=make_update(user_id, args.text), headers=headers) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(args.user_id + i) for i in range(args.count)))
+        elapsed = time.perf_counter() - started
+
+    print(f"Отправлено {args.count} обновлений за {elapsed:.2f} с "
+          f"({args.count / elapsed:.0f} в секунду), ответы: {statuses}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())